@@ -0,0 +1,133 @@
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from routers.middleware import ClientInfoMiddleware
+from util import ratelimits, timing
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+import argparse
+import asyncio
+import json
+import time
+
+
+"""
+Per-request overhead of the middleware.
+
+Calls a FastAPI app with one small endpoint directly through ASGI (no
+server or HTTP client in the way), with no middleware, with the old
+BaseHTTPMiddleware dispatch function and with ClientInfoMiddleware.
+
+Usage:
+  python benchmarks/middleware.py --requests 20000
+"""
+
+
+async def legacy_dispatch(request:Request, call_next):
+    """
+    The dispatch function ClientInfoMiddleware replaced, for comparison.
+    """
+
+    req_start_time = time.time()
+    client_info = {}
+
+    client_info_header = request.headers.get("X-Client-Info")
+    if client_info_header is not None:
+        try:
+            client_info = json.loads(client_info_header)
+        except:
+            raise HTTPException(status_code=400, detail="Unable to parse client info header")
+
+    client_info["ua"] = request.headers.get("User-Agent")
+    if (os.getenv("TRUST_CF", "false").lower() == "true") and (request.headers.get("CF-Connecting-IP") is not None):
+        client_info["ip"] = request.headers.get("CF-Connecting-IP")
+    elif (os.getenv("TRUST_PROXY", "false").lower() == "true") and (request.headers.get("X-Forwarded-For") is not None):
+        client_info["ip"] = request.headers.get("X-Forwarded-For")
+    else:
+        client_info["ip"] = request.client.host
+    request.state.client_info = client_info
+
+    try:
+        ratelimits.auto_ratelimit("global", client_info["ip"])
+    except HTTPException as err:
+        return JSONResponse({"detail": err.detail}, status_code = err.status_code, headers = err.headers)
+
+    resp = await call_next(request)
+    resp.headers["X-Process-Time"] = str(time.time() - req_start_time)
+    return resp
+
+
+def make_app(middleware:str):
+    app = FastAPI()
+
+    @app.get("/")
+    async def index(request:Request):
+        return {"ip": request.state.client_info["ip"] if hasattr(request.state, "client_info") else None}
+
+    if middleware == "base":
+        app.add_middleware(BaseHTTPMiddleware, dispatch = legacy_dispatch)
+    elif middleware == "asgi":
+        app.add_middleware(ClientInfoMiddleware)
+    return app
+
+
+async def run(app, requests:int):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/",
+        "raw_path": b"/",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [
+            (b"host", b"localhost"),
+            (b"user-agent", b"benchmark"),
+            (b"x-client-info", b'{"name": "benchmark"}')
+        ],
+        "client": ("127.0.0.1", 12345),
+        "server": ("localhost", 80)
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    statuses = []
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    # Warm up routing and the middleware stack
+    for i in range(100):
+        await app(dict(scope), receive, send)
+
+    started = time.perf_counter()
+    for i in range(requests):
+        await app(dict(scope), receive, send)
+    elapsed = (time.perf_counter() - started)
+
+    if any(status != 200 for status in statuses):
+        raise RuntimeError(f"Unexpected response statuses: {set(statuses)}")
+    return (elapsed / requests) * 1000000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Compare the per-request overhead of the middleware implementations.")
+    parser.add_argument("--requests", type = int, default = 20000, help = "requests per implementation")
+    args = parser.parse_args()
+
+    # Don't let the global ratelimit get in the way
+    ratelimits.policies = ratelimits.compile_policies({"global": {"limit": 1000000000, "ttl": 60}})
+    timing.TIMING_LOG_SAMPLE_RATE = 0
+
+    results = {}
+    for middleware in ["none", "base", "asgi"]:
+        results[middleware] = asyncio.run(run(make_app(middleware), args.requests))
+
+    print(f"{'middleware':<22} {'us/request':>11} {'overhead us':>12}")
+    for middleware, label in [("none", "none"), ("base", "BaseHTTPMiddleware"), ("asgi", "ClientInfoMiddleware")]:
+        print(f"{label:<22} {results[middleware]:>11.1f} {(results[middleware] - results['none']):>12.1f}")
@@ -0,0 +1,200 @@
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util.schema import migrate, build_indexes
+from util.queries import QUERIES
+import argparse
+import tempfile
+import json
+import sqlite3
+import random
+import time
+import re
+
+
+"""
+Query plan regression check.
+
+Seeds a SQLite database with the server's schema and a production-sized
+amount of rows, then runs EXPLAIN QUERY PLAN on every statement in
+util/queries.py and times it. Exits with status 1 if any statement
+scans a whole table (or needs an index that doesn't exist), so index
+changes can be checked before they ship.
+
+Usage:
+  python benchmarks/query_plans.py --accounts 1000000 --sessions 3
+"""
+
+
+# Plan steps that read every row of a table or index, "SCAN sessions" but not "SCAN CONSTANT ROW"
+# or "SCAN json_each", which reads the JSON array of values passed in as a parameter
+FULL_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW|json_each )")
+
+
+# Plan steps that sort rows after reading them
+TEMP_SORT = re.compile(r"USE TEMP B-TREE")
+
+
+def seed(con:sqlite3.Connection, accounts:int, sessions:int, batch_size:int = 50000):
+    """
+    Fill the database with accounts, each with some sessions, an
+    authenticator, recovery codes, an email link or a pending deletion.
+    Half of the sessions, email links and deletions are already due.
+    """
+
+    now = time.time()
+
+    def batches(rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    for batch in batches((f"u{i}", f"user{i}", f"user{i}@example.com", "$argon2id$", "[]", "[]", "[]", 0) for i in range(accounts)):
+        con.executemany("INSERT INTO accounts VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+    for batch in batches(
+        (f"s{i}-{j}", f"auth{i}-{j}", f"main{i}-{j}", f"u{i}", "{}", (now - j), (now + (j % 2 * 2 - 1) * 3600))
+        for i in range(accounts) for j in range(sessions)
+    ):
+        con.executemany("INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+    for batch in batches((f"t{i}", f"u{i}", "Phone", "SECRET") for i in range(0, accounts, 10)):
+        con.executemany("INSERT INTO totp_authenticators VALUES (?, ?, ?, ?)", batch)
+    for batch in batches((f"u{i}", f"code{i}-{j}") for i in range(0, accounts, 10) for j in range(8)):
+        con.executemany("INSERT INTO recovery_codes VALUES (?, ?)", batch)
+    for batch in batches((f"e{i}", f"u{i}", f"user{i}@example.com", "verify_email", int(now + (i % 2 * 2 - 1) * 3600)) for i in range(0, accounts, 10)):
+        con.executemany("INSERT INTO email_links VALUES (?, ?, ?, ?, ?)", batch)
+    for batch in batches((f"u{i}", (now + (i % 2 * 2 - 1) * 86400)) for i in range(0, accounts, 100)):
+        con.executemany("INSERT INTO pending_deletion VALUES (?, ?)", batch)
+
+
+def sample_params(accounts:int):
+    """
+    Get parameters for every query, picked from the seeded rows.
+    """
+
+    i = random.randrange(0, accounts, 10)
+    now = time.time()
+    return {
+        "account_by_id": (f"u{i}",),
+        "account_by_username": (f"user{i}",),
+        "account_by_email": (f"user{i}@example.com",),
+        "create_account": (f"new{i}", f"new{i}", None, None, "[]", 0),
+        "update_account_email": (f"new{i}@example.com", f"u{i}"),
+        "update_account_password": ("$argon2id$", f"u{i}"),
+        "update_account_lock_status": (1, f"u{i}"),
+        "totp_by_user": (f"u{i}",),
+        "add_totp": (f"newt{i}", f"u{i}", "Phone", "SECRET"),
+        "remove_totp": (f"t{i}", f"u{i}"),
+        "add_recovery_code": (f"u{i}", "newcode"),
+        "remove_recovery_code": (f"u{i}", f"code{i}-0"),
+        "remove_recovery_codes": (f"u{i}",),
+        "count_recovery_codes": (f"u{i}",),
+        "session_by_id": (f"s{i}-0",),
+        "session_by_auth_hash": (f"auth{i}-0",),
+        "create_session": (f"news{i}", f"newauth{i}", f"newmain{i}", f"u{i}", "{}", now, (now + 3600)),
+        "refresh_session": (f"newauth{i}", f"newmain{i}", now, (now + 3600), f"s{i}-0"),
+        "delete_session": (f"s{i}-0",),
+        "delete_user_sessions": (f"u{i}",),
+        "list_sessions": (f"u{i}", 26),
+        "list_sessions_after": (f"u{i}", now, f"s{i}-0", 26),
+        "introspect_sessions": (json.dumps([f"main{random.randrange(accounts)}-0" for _ in range(1000)]),),
+        "email_link_by_id": (f"e{i}",),
+        "create_email_link": (f"newe{i}", f"u{i}", f"user{i}@example.com", "verify_email", int(now + 3600)),
+        "delete_email_link": (f"e{i}",),
+        "due_account_deletions": (now,),
+        "delete_account": (f"u{i}",),
+        "remove_user_totp": (f"u{i}",),
+        "remove_pending_deletion": (f"u{i}",),
+        "sweep_sessions": (now, 500),
+        "sweep_email_links": (now, 500),
+    }
+
+
+def check_plan(con:sqlite3.Connection, name:str, params):
+    """
+    Get the plan of a query and what is wrong with it.
+    """
+
+    plan = [row[3] for row in con.execute(f"EXPLAIN QUERY PLAN {QUERIES[name]}", params).fetchall()]
+    problems = []
+    for step in plan:
+        if FULL_SCAN.search(step):
+            problems.append(f"full scan: {step}")
+        elif TEMP_SORT.search(step):
+            problems.append(f"sorts rows: {step}")
+    return plan, problems
+
+
+def time_query(con:sqlite3.Connection, name:str, accounts:int, iterations:int):
+    """
+    Run a query with fresh parameters every iteration, writes are rolled
+    back so every iteration sees the same data.
+    """
+
+    timings = []
+    for _ in range(iterations):
+        params = sample_params(accounts)[name]
+        con.execute("SAVEPOINT bench")
+        started = time.perf_counter()
+        con.execute(QUERIES[name], params).fetchall()
+        timings.append((time.perf_counter() - started) * 1000000)
+        con.execute("ROLLBACK TO bench")
+        con.execute("RELEASE bench")
+    timings.sort()
+    return timings[len(timings) // 2], timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Check the query plans and timings of every SQL statement against a seeded database.")
+    parser.add_argument("--accounts", type = int, default = 1000000, help = "accounts to seed")
+    parser.add_argument("--sessions", type = int, default = 3, help = "sessions to seed per account")
+    parser.add_argument("--iterations", type = int, default = 1000, help = "timed runs per query")
+    parser.add_argument("--db", help = "reuse a database seeded by an earlier run")
+    args = parser.parse_args()
+
+    path = (args.db or os.path.join(tempfile.mkdtemp(), "query_plans.db"))
+    reuse = os.path.exists(path)
+    con = sqlite3.connect(path, isolation_level = None)
+    con.execute("PRAGMA journal_mode = WAL")
+    if not reuse:
+        migrate(con)
+
+        started = time.time()
+        con.execute("BEGIN")
+        seed(con, args.accounts, args.sessions)
+        con.execute("COMMIT")
+        print(f"Seeded {args.accounts} accounts with {args.sessions} sessions each in {time.time() - started:.1f}s ({path})")
+
+    # Indexes are built after startup, like the server does
+    started = time.time()
+    build_indexes(con)
+    print(f"Built indexes in {time.time() - started:.1f}s")
+
+    failed = []
+    params = sample_params(args.accounts)
+    print(f"{'query':<28} {'p50 us':>9} {'p99 us':>9}  plan")
+    for name in QUERIES:
+        try:
+            plan, problems = check_plan(con, name, params[name])
+            p50, p99 = time_query(con, name, args.accounts, args.iterations)
+        except sqlite3.Error as err:
+            print(f"{name:<28} {'-':>9} {'-':>9}  error: {str(err)}")
+            failed.append(name)
+            continue
+        print(f"{name:<28} {p50:>9.1f} {p99:>9.1f}  {' | '.join(plan)}")
+        for problem in problems:
+            print(f"  !! {problem}")
+        if len(problems) > 0:
+            failed.append(name)
+
+    con.close()
+    if len(failed) > 0:
+        print(f"\n{len(failed)} queries failed: {', '.join(failed)}")
+        sys.exit(1)
+    else:
+        print(f"\nAll {len(QUERIES)} queries use indexes")
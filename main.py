@@ -1,5 +1,4 @@
 from fastapi import FastAPI
-from starlette.middleware.base import BaseHTTPMiddleware
 from dotenv import load_dotenv
 
 
@@ -13,8 +12,8 @@ if __name__ == "__main__":
 
 
     # Import and attatch middleware
-    from routers.middleware import middleware_dispatch
-    app.add_middleware(BaseHTTPMiddleware, dispatch=middleware_dispatch)
+    from routers.middleware import ClientInfoMiddleware
+    app.add_middleware(ClientInfoMiddleware)
 
 
     # Import and attatch routers
@@ -26,4 +25,30 @@ if __name__ == "__main__":
 
     from routers.account import authentication, sessions
     app.include_router(authentication.router)
-    app.include_router(sessions.router)
\ No newline at end of file
+    app.include_router(sessions.router)
+
+
+    # Start listening for revoked sessions
+    from util.sessions import session_cache
+    session_cache.listen()
+
+
+    # Reload ratelimit policies when the policy file changes
+    from util.ratelimits import watch_policies
+    watch_policies()
+
+
+    # Start the storage backend's background work
+    from util.storage import storage
+    storage.start()
+
+
+    # Stop password hashing workers on shutdown
+    from util import passwords
+    app.add_event_handler("shutdown", passwords.shutdown)
+    app.add_event_handler("shutdown", storage.close)
+
+
+    # Close the captcha provider's connection pool on shutdown
+    from util.captcha import verifier
+    app.add_event_handler("shutdown", verifier.close)
\ No newline at end of file
@@ -23,10 +23,10 @@ async def change_email(req:Request, body:ChangeEmail):
         raise HTTPException(status_code = 400, detail = "Illegal characters detected")
 
     # Generate email token
-    token = req.session.user.generate_email_token("verify_email", 86400)
+    token = await req.state.session.user.generate_email_token("verify_email", 86400)
 
     # Send email
-    send_email(body.new_email, "verify_email", {"username": req.session.user.username}, token)
+    send_email(body.new_email, "verify_email", {"username": req.state.session.user.username}, token)
 
     return "OK"
 
@@ -38,7 +38,7 @@ async def change_password(req:Request, body:ChangePassword):
     """
 
     # Update password
-    req.session.user.update_password(body.new_password)
+    await req.state.session.user.update_password(body.new_password)
 
     return "OK"
 
@@ -59,15 +59,16 @@ async def add_totp(req:Request, body:NewTOTP):
     """
 
     # Attempt to add TOTP authenticator
-    success, authenticator_id = req.session.user.add_totp(body.nickname, body.secret, body.code)
+    success, authenticator_id = await req.state.session.user.add_totp(body.name, body.secret, body.code)
     if not success:
         raise HTTPException(status_code = 400, detail = "Invalid TOTP code")
     
     # Generate recovery codes if there are none
-    if len(req.session.user.recovery) == 0:
-        req.session.user.refresh_recovery()
+    recovery_codes = None
+    if (await req.state.session.user.recovery_remaining()) == 0:
+        recovery_codes = await req.state.session.user.refresh_recovery()
 
-    return {"authenticator_id": authenticator_id, "recovery_codes": req.session.user.recovery}
+    return {"authenticator_id": authenticator_id, "recovery_codes": recovery_codes}
 
 
 @router.delete("/totp/{authenticator_id}")
@@ -77,7 +78,7 @@ async def remove_totp(req:Request, authenticator_id:str):
     """
 
     # Attempt to remove TOTP authenticator
-    status = req.session.user.remove_totp(authenticator_id)
+    status = await req.state.session.user.remove_totp(authenticator_id)
 
     if status:
         return "OK"
@@ -88,10 +89,13 @@ async def remove_totp(req:Request, authenticator_id:str):
 @router.get("/recovery")
 async def get_recovery(req:Request):
     """
-    Get recovery codes for the authorized user.
+    Get the amount of unused recovery codes for the authorized user.
+
+    Recovery codes are only stored hashed, so they can only be seen
+    when they are generated.
     """
 
-    return req.session.user.recovery
+    return {"remaining": await req.state.session.user.recovery_remaining()}
 
 
 @router.post("/recovery")
@@ -100,6 +104,4 @@ async def refresh_recovery(req:Request):
     Refresh recovery codes for the authorized user.
     """
 
-    req.session.user.refresh_recovery()
-
-    return req.session.user.recovery
+    return await req.state.session.user.refresh_recovery()
@@ -1,6 +1,5 @@
-from util.database import db
-from util.sessions import Session, check_auth, revoke_all_sessions
-from fastapi import APIRouter, Request, Depends, HTTPException
+from util.sessions import session_from_id, check_auth, revoke_all_sessions, list_sessions
+from fastapi import APIRouter, Request, Depends, HTTPException, Query
 
 
 router = APIRouter(
@@ -11,25 +10,22 @@ router = APIRouter(
 
 
 @router.get("/")
-async def get_all_sessions(req:Request):
+async def get_all_sessions(req:Request, limit:int = Query(default = 25, ge = 1, le = 100), cursor:str = None):
     """
-    Get details about all sessions.
+    Get details about all sessions, one page at a time.
     """
 
-    # Get all sessions from the database
-    sessions = db.cur.execute("SELECT * FROM sessions WHERE user = ?", (req.user.id,)).fetchall()
+    # Get a page of sessions from the database
+    try:
+        sessions, next_cursor = await list_sessions(req.state.session.user.id, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code = 400, detail = "Invalid cursor")
 
-    # Parse all sessions
-    parsed_sessions = []
-    for session_obj in sessions:
-        parsed_sessions.append({
-            "id": session_obj[0],
-            "client": session_obj[3],
-            "refreshed": session_obj[5]
-        })
-
-    # Return all sessions
-    return parsed_sessions
+    # Return sessions and the cursor for the next page
+    return {
+        "sessions": sessions,
+        "next_cursor": next_cursor
+    }
 
 
 @router.get("/{session_id}")
@@ -39,8 +35,8 @@ async def get_session(req:Request, session_id):
     """
 
     # Get session details
-    session = Session(session_id)
-    if (not session._valid) or (session.user != req.session.user.id):
+    session = await session_from_id(session_id)
+    if (not session._valid) or (session.user.id != req.state.session.user.id):
         raise HTTPException(status_code = 400, detail = "Unknown session")
     
     # Return session data
@@ -58,12 +54,12 @@ async def revoke_session(req:Request, session_id):
     """
 
     # Get session details
-    session = Session(session_id)
-    if (not session._valid) or (session.user != req.session.user.id):
+    session = await session_from_id(session_id)
+    if (not session._valid) or (session.user.id != req.state.session.user.id):
         raise HTTPException(status_code = 400, detail = "Unknown session")
     
     # Revoke session
-    session.revoke()
+    await session.revoke()
 
     return "OK"
 
@@ -75,6 +71,6 @@ async def revoke_all(req:Request):
     """
 
     # Revoke all sessions
-    revoke_all_sessions(req.session.user)
+    await revoke_all_sessions(req.state.session.user.id)
 
     return "OK"
@@ -16,10 +16,10 @@ async def get_session(req:Request):
     """
 
     return {
-        "id": req.session.id,
-        "user": req.session.user,
-        "client": req.session.client,
-        "expires": req.session.expires
+        "id": req.state.session.id,
+        "user": req.state.session.user.id,
+        "client": req.state.session.client,
+        "expires": req.state.session.expires
     }
 
 
@@ -29,7 +29,7 @@ async def revoke_session(req:Request):
     Revoke current session.
     """
 
-    req.session.revoke()
+    await req.state.session.revoke()
     return "OK"
 
 
@@ -39,9 +39,9 @@ async def refresh_session(req:Request):
     Refresh current session.
     """
 
-    auth_token, main_token = req.session.refresh(req.client.info)
+    auth_token, main_token = await req.state.session.refresh()
     return {
-        "id": req.session.id,
+        "id": req.state.session.id,
         "auth_token": auth_token,
         "main_token": main_token
     }
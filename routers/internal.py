@@ -1,15 +1,20 @@
-from util.database import db
 from util.accounts import acc_from_id
+from util.sessions import introspect_main_hashes
+from util.tokens import hash_main_token, key_set
 from util.emails import send_email
-from fastapi import APIRouter, HTTPException, Request, Header, Depends
-from util.schemas.internal import SendEmail, LockAccount
+from util import metrics, profiler
+from fastapi import APIRouter, HTTPException, Request, Response, Header, Depends
+from fastapi.responses import PlainTextResponse
+from util.schemas.internal import SendEmail, LockAccount, IntrospectTokens, Profile
+import asyncio
+import time
 import os
 import json
 
 
 def check_auth(req:Request, secret_key:str = Header()):
     # Check secret key and IP whitelist
-    if req.client.info["ip"] not in json.loads(os.getenv("INTERNAL_IPS")):
+    if req.state.client_info["ip"] not in json.loads(os.getenv("INTERNAL_IPS")):
         raise HTTPException(status_code = 404)  # Standard 404 error code to not give the client any hints
     elif secret_key != os.getenv("SECRET_KEY"):
         raise HTTPException(status_code = 403, detail = "Invalid secret key")
@@ -25,7 +30,7 @@ router = APIRouter(
 @router.post("/send-email")
 async def req_send_email(body:SendEmail):
     # Get user
-    user = acc_from_id(body.user)
+    user = await acc_from_id(body.user)
 
     # Check user
     if not user._exists:
@@ -44,13 +49,69 @@ async def req_send_email(body:SendEmail):
 @router.post("/lock-account")
 async def lock_account(body:LockAccount):
     # Get user
-    user = acc_from_id(body.user)
+    user = await acc_from_id(body.user)
 
     # Check user
     if not user._exists:
         raise HTTPException(status_code = 404, detail = "User not found")
     
     # Lock the account
-    user.change_lock_status(body.mode)
+    await user.change_lock_status(body.mode)
 
     return "OK"
+
+
+@router.post("/profile")
+async def profile(body:Profile):
+    """
+    Sample the stacks of this worker for a while and get them as collapsed stacks.
+    """
+
+    # Sample from another thread so the event loop gets sampled too
+    stacks, stats = await asyncio.get_running_loop().run_in_executor(None, profiler.sample, body.seconds, body.interval)
+
+    return PlainTextResponse(profiler.collapse(stacks), headers = {
+        "Content-Disposition": f'attachment; filename="profile-{os.getpid()}-{int(time.time())}.collapsed"',
+        "X-Profile-Seconds": str(stats["seconds"]),
+        "X-Profile-Samples": str(stats["samples"]),
+        "X-Profile-Overhead": str(stats["overhead"])
+    })
+
+
+
+@router.post("/introspect")
+async def introspect(body:IntrospectTokens):
+    """
+    Get the user, expiry and lock status of many main tokens or main token hashes.
+    """
+
+    # Look up every main token and hash at once
+    main_hashes = ([hash_main_token(main_token) for main_token in body.tokens] + body.hashes)
+    results = await introspect_main_hashes(main_hashes)
+
+    # Return results in the same order as requested
+    return {
+        "tokens": results[:len(body.tokens)],
+        "hashes": results[len(body.tokens):]
+    }
+
+
+
+@router.get("/keys")
+async def main_token_keys(resp:Response):
+    """
+    Get the keys used to verify signed main tokens.
+    """
+
+    resp.headers["Cache-Control"] = "private, max-age=300"
+    return key_set()
+
+
+
+@router.get("/metrics")
+async def get_metrics():
+    """
+    Get this worker's metrics in the Prometheus text format.
+    """
+
+    return PlainTextResponse(metrics.render(), media_type = "text/plain; version=0.0.4")
@@ -1,40 +1,100 @@
 from util.ratelimits import auto_ratelimit
-from fastapi import Request, HTTPException
+from util import timing, metrics
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
 import time
 import json
 import os
 
 
-async def middleware_dispatch(request:Request, call_next):
-    # Initialize start time and client info object
-    req_start_time = time.time()
-    request.client.info = {}
+metrics.describe("http_requests_total", "counter", "Requests by route and status", ("method", "route", "status"))
+metrics.describe("http_request_duration_seconds", "histogram", "Request latency by route", ("method", "route"))
 
-    # Get client info from header
-    client_info_header = request.headers.get("X-Client-Info")
-    if client_info_header is not None:
+
+class ClientInfoMiddleware:
+    """
+    Raw ASGI middleware that parses client info, applies the global
+    ratelimit and adds the X-Process-Time and Server-Timing headers.
+
+    Client info (the X-Client-Info header plus the user agent and IP
+    address) is stored in request.state.client_info.
+    """
+
+    def __init__(self, app, trust_cf:bool = None, trust_proxy:bool = None):
+        self.app = app
+
+        # Read once instead of on every request
+        self.trust_cf = ((os.getenv("TRUST_CF", "false").lower() == "true") if trust_cf is None else trust_cf)
+        self.trust_proxy = ((os.getenv("TRUST_PROXY", "false").lower() == "true") if trust_proxy is None else trust_proxy)
+
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        # Initialize start time and get the headers we need
+        req_start_time = time.perf_counter()
+        client_info_header = None
+        user_agent = None
+        cf_ip = None
+        forwarded_for = None
+        for name, value in scope["headers"]:
+            if name == b"x-client-info":
+                client_info_header = value
+            elif name == b"user-agent":
+                user_agent = value.decode("latin-1")
+            elif name == b"cf-connecting-ip":
+                cf_ip = value.decode("latin-1")
+            elif name == b"x-forwarded-for":
+                forwarded_for = value.decode("latin-1")
+
+        # Get client info from header
+        client_info = {}
+        if client_info_header is not None:
+            try:
+                client_info = json.loads(client_info_header)
+                if not isinstance(client_info, dict):
+                    raise ValueError
+            except:
+                return await JSONResponse({"detail": "Unable to parse client info header"}, status_code = 400)(scope, receive, send)
+
+        # Add user agent and IP address to client info
+        client_info["ua"] = user_agent
+        if self.trust_cf and (cf_ip is not None):
+            client_info["ip"] = cf_ip
+        elif self.trust_proxy and (forwarded_for is not None):
+            # The last address is the one our proxy saw, anything before it is up to the client
+            client_info["ip"] = forwarded_for.rsplit(",", 1)[-1].strip()
+        else:
+            client_info["ip"] = (scope["client"][0] if scope.get("client") else None)
+        scope.setdefault("state", {})["client_info"] = client_info
+
+        # Check ratelimit
+        try:
+            auto_ratelimit("global", client_info["ip"])
+        except HTTPException as err:
+            return await JSONResponse({"detail": err.detail}, status_code = err.status_code, headers = err.headers)(scope, receive, send)
+
+        # Add processing time and Server-Timing headers to response
+        spans = timing.start_request()
+        status = None
+        async def send_with_time(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                elapsed = (time.perf_counter() - req_start_time)
+                headers = [*message.get("headers", []), (b"x-process-time", str(elapsed).encode())]
+                if timing.SERVER_TIMING:
+                    headers.append((b"server-timing", timing.server_timing(spans, elapsed).encode()))
+                message["headers"] = headers
+            await send(message)
+
+        # Finish request
         try:
-            request.client.info = json.loads(client_info_header)
-        except:
-            raise HTTPException(status_code=400, detail="Unable to parse client info header")
-
-    # Add user agent and IP address to client info
-    request.client.info["ua"] = request.headers.get("User-Agent")
-    if (os.getenv("TRUST_CF").lower() == "true") and (request.headers.get("CF-Connecting-IP") is not None):
-        request.client.info["ip"] = request.headers.get("CF-Connecting-IP")
-    elif (os.getenv("TRUST_PROXY").lower() == "true") and (request.headers.get("X-Forwarded-For") is not None):
-        request.client.info["ip"] = request.headers.get("X-Forwarded-For")
-    else:
-        request.client.info["ip"] = request.client.host
-
-    # Check ratelimit
-    auto_ratelimit("global", request.client.info["ip"], 30, 60)
-
-    # Finish request
-    resp = await call_next(request)
-
-    # Add processing time header to response
-    resp.headers["X-Process-Time"] = str(time.time() - req_start_time)
-
-    # Return response payload
-    return resp
+            await self.app(scope, receive, send_with_time)
+        finally:
+            elapsed = (time.perf_counter() - req_start_time)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            metrics.inc("http_requests_total", (scope["method"], route, str(status)))
+            metrics.observe("http_request_duration_seconds", elapsed, (scope["method"], route))
+            timing.log_request(scope["method"], scope["path"], status, spans, elapsed)
@@ -1,53 +1,90 @@
-from util.database import db
-from util.supporter import log, snowflake
+from util.storage import storage
+from util.supporter import log, snowflake, hash_recovery_code
+from util import passwords
+from util.tokens import create_main_token
 from hashlib import sha256
-from passlib.hash import bcrypt
 from pyotp import TOTP
 import json
 import time
 import secrets
 import string
-import os
 
 
 RECOVERY_CODE_CHARS = (string.ascii_lowercase + string.digits)
 
 
+# Lifetime of sessions (in seconds)
+SESSION_TTL = 7890000
+
+
+class LazyJSON:
+    """
+    Account field that is stored as JSON and only decoded on first access.
+    """
+
+    def __init__(self, slot:str):
+        self.slot = slot
+
+
+    def __get__(self, obj, objtype = None):
+        if obj is None:
+            return self
+
+        # Decode and cache the value
+        value = getattr(obj, self.slot)
+        if isinstance(value, str):
+            value = json.loads(value)
+            setattr(obj, self.slot, value)
+        return value
+
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+
 class Account:
+    __slots__ = ("_exists", "id", "username", "email", "password", "_webauthn", "_totp", "lock_status")
+
+    webauthn = LazyJSON("_webauthn")
+
+
     def __init__(self, userdata:tuple):
         self._exists = (userdata is not None)
         
         if self._exists:
             # Unpack userdata
-            self.id = userdata[0]
-            self.username = userdata[1]
-            self.email = userdata[2]
-            self.password = userdata[3]
-            self.webauthn = json.loads(userdata[4])
-            self.totp = json.loads(userdata[5])
-            self.recovery = json.loads(userdata[6])
-            self.lock_status = userdata[7]
+            self.id, self.username, self.email, self.password, self._webauthn, self.lock_status = userdata
+            self._totp = None
         else:
             # Create default userdata
             self.id = None
             self.username = None
             self.email = None
             self.password = None
-            self.webauthn = []
-            self.totp = []
-            self.recovery = []
+            self._webauthn = []
+            self._totp = []
             self.lock_status = 0
 
 
-    def create(self, username, display_name, password, child):
+    async def get_totp(self):
+        # Get TOTP authenticators on first access
+        if self._totp is None:
+            self._totp = await storage.accounts.get_totp(self.id)
+        return self._totp
+
+
+    async def create(self, username, display_name, password, child):
+        # Hash password before claiming the username
+        password_hash = await passwords.hash_password(password)
+
         # Update attributes on account object
         self._exists = True
         self.id = snowflake()
         self.username = username.lower()
-        self.password = bcrypt.hash(password, salt = int(os.getenv("SALT_STRENGTH", 14)))
+        self.password = password_hash
 
-        # Insert account into Mongo database
-        db.mongo.users.insert_one({
+        # Insert account and its profile into the database
+        await storage.accounts.create((self.id, self.username, self.email, self.password, json.dumps(self.webauthn), self.lock_status), {
             "_id": self.id,
             "username": display_name,
             "username_lower": display_name.lower(),
@@ -58,33 +95,33 @@ class Account:
             "custom_theme": {},
             "quote": "",
             "following": []
-        }, {"writeConcern": {"w": "majority", "wtimeout": 5000}})
-
-        # Insert account into SQLite database
-        db.cur.execute("INSERT INTO accounts VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (self.id, self.username, self.email, self.password, self.webauthn, self.totp, self.recovery, self.lock_status,))
-        db.con.commit()
+        })
 
         return True
 
 
-    def update_email(self, email:str):
+    async def update_email(self, email:str):
         # Update email on account object
         self.email = email
 
         # Update account in database
-        db.cur.execute("UPDATE accounts SET email = ? WHERE id = ?", (self.email, self.id,))
-        db.con.commit()
+        await storage.accounts.update(self.id, "email", self.email)
 
         return True
 
 
-    def verify_password(self, password:str):
+    async def verify_password(self, password:str):
         # Make sure password is set
         if self.password is None:
             return False
 
         # Check if password is valid
-        pswd_valid =  bcrypt.verify(password, self.password)
+        pswd_valid, new_hash = await passwords.verify_password(password, self.password)
+
+        # Upgrade hash if it doesn't match the current policy
+        if pswd_valid and (new_hash is not None):
+            self.password = new_hash
+            await storage.accounts.update(self.id, "password", self.password)
 
         # Return password validity
         if pswd_valid:
@@ -93,45 +130,44 @@ class Account:
             return False
 
 
-    def update_password(self, password:str):
+    async def update_password(self, password:str):
         # Hash new password and update attribute
-        self.password = bcrypt.hash(password, salt = int(os.getenv("SALT_STRENGTH", 14)))
+        self.password = await passwords.hash_password(password)
 
         # Update password in database
-        db.cur.execute("UPDATE accounts SET password = ? WHERE id = ?", (self.password, self.id,))
-        db.con.commit()
+        await storage.accounts.update(self.id, "password", self.password)
 
         return True
 
 
-    def add_totp(self, nickname:str, secret:str, code:str):
+    async def add_totp(self, nickname:str, secret:str, code:str):
         # Verify and add TOTP code
         try:
             if TOTP(secret).verify(code):
                 authenticator_id = snowflake()
-                self.totp.append({"id": authenticator_id, "name": nickname, "secret": secret})
-                db.cur.execute("UPDATE accounts SET totp = ? WHERE id = ?", (json.dumps(self.totp), self.id,))
-                db.con.commit()
-                return True
+                await storage.accounts.add_totp(self.id, authenticator_id, nickname, secret)
+                if self._totp is not None:
+                    self._totp.append({"id": authenticator_id, "name": nickname, "secret": secret})
+                return True, authenticator_id
             else:
-                return False
+                return False, None
         except:
-            return False
+            return False, None
 
 
-    def remove_totp(self, authenticator_id:str):
-        # Loop through authenticators and find authenticator to remove
-        for authenticator in self.totp:
-            if authenticator["id"] == authenticator_id:
-                self.totp.remove(authenticator)
-                db.cur.execute("UPDATE accounts SET totp = ? WHERE id = ?", (json.dumps(self.totp), self.id,))
-                db.con.commit()
-                return True
+    async def remove_totp(self, authenticator_id:str):
+        # Delete authenticator if it belongs to the account
+        if not await storage.accounts.remove_totp(self.id, authenticator_id):
+            return False
 
-        return False
+        # Update cached authenticators
+        if self._totp is not None:
+            self._totp = [authenticator for authenticator in self._totp if authenticator["id"] != authenticator_id]
+
+        return True
 
 
-    def refresh_recovery(self):
+    async def refresh_recovery(self):
         # Create new recovery codes
         recovery_codes = []
         for i in range(8):
@@ -145,154 +181,139 @@ class Account:
             
             # Append to list
             recovery_codes.append(new_code)
-        
-        # Update recovery attribute
-        self.recovery = recovery_codes
 
-        # Update recovery in database
-        db.cur.execute("UPDATE accounts SET recovery = ? WHERE id = ?", (json.dumps(self.recovery), self.id,))
-        db.con.commit()
+        # Replace recovery codes in database, only hashes are stored
+        await storage.accounts.replace_recovery(self.id, [hash_recovery_code(self.id, code) for code in recovery_codes])
         
         return recovery_codes
 
 
-    def remove_recovery(self, code:int = None):
-        # Update recovery attribute
+    async def remove_recovery(self, code:str = None):
+        # Delete one or all recovery codes from database
         if code is None:
-            self.recovery = []
+            return await storage.accounts.remove_recovery(self.id)
         else:
-            self.recovery.remove(code)
+            return await storage.accounts.remove_recovery(self.id, hash_recovery_code(self.id, code))
 
-        # Update recovery in database
-        db.cur.execute("UPDATE accounts SET recovery = ? WHERE id = ?", (json.dumps(self.recovery), self.id,))
-        db.con.commit()
 
-        return True
+    async def recovery_remaining(self):
+        # Get amount of unused recovery codes
+        return await storage.accounts.count_recovery(self.id)
 
 
-    def verify_totp(self, code:str):
+    async def verify_totp(self, code:str):
         # Loop through authenticators and check authenticator secret
-        for authenticator in self.totp:
+        for authenticator in await self.get_totp():
             if TOTP(authenticator["secret"]).verify(code):
                 return True
 
         return False
 
 
-    def change_lock_status(self, mode:int):
+    async def change_lock_status(self, mode:int):
         self.lock_status = mode
-        db.cur.execute("UPDATE accounts SET lock_status = ? WHERE id = ?", (self.lock_status, self.id,))
-        db.con.commit()
+        await storage.accounts.update(self.id, "lock_status", self.lock_status)
 
         return True
 
 
-    def generate_session(self, client):
+    async def generate_session(self, client):
         # Create session snowflake
         session_id = snowflake()
 
-        # Create auth and main token secrets
+        # Create auth and main tokens
         auth_token = ("meow-auth_" + secrets.token_urlsafe(128))
-        main_token = ("meow-main_" + secrets.token_urlsafe(64))
+        main_token, hashed_main_token = create_main_token(self.id, session_id)
 
-        # Create auth and main token hashes
+        # Create auth token hash
         hashed_auth_token = sha256(auth_token.encode()).hexdigest()
-        hashed_main_token = sha256(main_token.encode()).hexdigest()[:16]
-
-        # Insert auth token into SQLite database
-        db.cur.execute("INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)", (session_id, hashed_auth_token, hashed_main_token, self.id, json.dumps(client), time.time(), (time.time() + 7890000),))
-        db.con.commit()
-
-        # Insert main token into Redis
-        db.redis.set(f"auth:{hashed_main_token}", self.user, ex = 3600)
 
-        # Insert main token into Mongo database
-        db.mongo.sessions.insert_one({
-            "_id": hashed_main_token,
-            "user": self.id,
-            "ttl": (time.time() + 3600)
-        }, {"writeConcern": {"w": "majority", "wtimeout": 5000}})
+        # Insert session and main token into the database
+        await storage.sessions.create((session_id, hashed_auth_token, hashed_main_token, self.id, json.dumps(client), time.time(), (time.time() + SESSION_TTL)))
 
         # Return auth and main token
         return auth_token, main_token
 
 
-    def generate_mfa_token(self):
+    async def generate_mfa_token(self):
         # Create token secret
         token = ("meow-mfa_" + secrets.token_urlsafe(128))
 
         # Create token hash
         hashed_token = sha256(token.encode()).hexdigest()
 
-        # Insert token into in-memory database
-        db.mem.execute("INSERT INTO mfa VALUES (?, ?, ?)", (hashed_token, self.id, (time.time() + 600),))
+        # Insert token into the database
+        await storage.mfa_tokens.create(hashed_token, self.id, (time.time() + 600))
 
         # Return token
         return token
 
 
-    def generate_email_token(self, action, ttl):
+    async def generate_email_token(self, action, ttl):
         # Create token secret
         token = ("meow-email_" + secrets.token_urlsafe(128))
 
         # Create token hash
         hashed_token = sha256(token.encode()).hexdigest()
 
-        # Insert token into SQLite database
-        db.cur.execute("INSERT INTO email_links VALUES (?, ?, ?, ?, ?)", (hashed_token, self.id, self.email, action, (int(time.time()) + ttl)))
-        db.con.commit()
+        # Insert token into the database
+        await storage.email_links.create((hashed_token, self.id, self.email, action, (int(time.time()) + ttl)))
 
         # Return token
         return token
 
 
-def acc_from_id(userid:str):
+async def acc_from_id(userid:str):
     # Get account data
-    userdata = db.cur.execute("SELECT * FROM accounts WHERE id = ?", (userid,)).fetchone()
+    userdata = await storage.accounts.get("id", userid)
 
     # Add log
-    log.store("got_account", {"method": "id", "user": userdata[0]})
+    if userdata is not None:
+        log.store("got_account", {"method": "id", "user": userdata[0]})
 
     # Return account
     return Account(userdata)
 
 
-def acc_from_username(username:str):
+async def acc_from_username(username:str):
     # Get account data
-    userdata = db.cur.execute("SELECT * FROM accounts WHERE username = ?", (username.lower(),)).fetchone()
+    userdata = await storage.accounts.get("username", username.lower())
 
     # Add log
-    log.store("got_account", {"method": "username", "user": userdata[0]})
+    if userdata is not None:
+        log.store("got_account", {"method": "username", "user": userdata[0]})
 
     # Return account
     return Account(userdata)
 
 
-def acc_from_email(email:str):
+async def acc_from_email(email:str):
     # Get account data
-    userdata = db.cur.execute("SELECT * FROM accounts WHERE email = ?", (email.lower(),)).fetchone()
+    userdata = await storage.accounts.get("email", email.lower())
 
     # Add log
-    log.store("got_account", {"method": "email", "user": userdata[0]})
+    if userdata is not None:
+        log.store("got_account", {"method": "email", "user": userdata[0]})
 
     # Return account
     return Account(userdata)
 
 
-def acc_from_mfa_token(token:str):
+async def acc_from_mfa_token(token:str):
     # Hash token
     hashed_token = sha256(token.encode()).hexdigest()
 
     # Get session data
-    token_data = db.mem.execute("SELECT * FROM mfa WHERE id = ?", (hashed_token,)).fetchone()
-    if int(time.time()) > token_data[2]:
+    token_data = await storage.mfa_tokens.get(hashed_token)
+    if (token_data is None) or (int(time.time()) > token_data[1]):
         return Account(None)
 
     # Get account data
-    userdata = db.cur.execute("SELECT * FROM accounts WHERE id = ?", (token_data[1],)).fetchone()
+    userdata = await storage.accounts.get("id", token_data[0])
 
     # Add log
-    log.store("got_account", {"method": "mfa_token", "user": userdata[0]})
+    if userdata is not None:
+        log.store("got_account", {"method": "mfa_token", "user": userdata[0]})
 
     # Return account
     return Account(userdata)
@@ -0,0 +1,179 @@
+from util.supporter import log
+from util.timing import span
+from util import metrics
+import httpx
+import time
+import os
+
+
+"""
+Captcha verification with Turnstile, reCAPTCHA or hCaptcha.
+
+Requests to the provider share one keep-alive connection pool and have
+strict timeouts. After too many failed requests in a row the circuit
+breaker opens and captchas are settled by the fail policy without
+contacting the provider, until a trial request after the cooldown
+succeeds again.
+
+Config:
+* CAPTCHA_PROVIDER - turnstile, recaptcha or hcaptcha (captchas aren't checked if unset)
+* CAPTCHA_SECRET - secret key for the provider
+* CAPTCHA_URL - verification endpoint override, e.g. a local stub provider
+* CAPTCHA_TIMEOUT - seconds a verification may take in total
+* CAPTCHA_CONNECT_TIMEOUT - seconds connecting to the provider may take
+* CAPTCHA_MAX_CONNECTIONS - size of the connection pool
+* CAPTCHA_FAIL_OPEN - whether captchas pass while the provider is unreachable
+* CAPTCHA_BREAKER_THRESHOLD - failed requests in a row that open the breaker
+* CAPTCHA_BREAKER_COOLDOWN - seconds the breaker stays open before a trial request
+"""
+
+
+PROVIDER_URLS = {
+    "turnstile": "https://challenges.cloudflare.com/turnstile/v0/siteverify",
+    "recaptcha": "https://www.google.com/recaptcha/api/siteverify",
+    "hcaptcha": "https://hcaptcha.com/siteverify"
+}
+
+
+class CircuitBreaker:
+    """
+    Stops calling a dependency after `threshold` failures in a row,
+    lets one trial call through every `cooldown` seconds while open.
+    """
+
+    def __init__(self, threshold:int, cooldown:float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self._trial = False
+
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return "closed"
+        elif self._trial or ((time.time() - self.opened) >= self.cooldown):
+            return "half_open"
+        else:
+            return "open"
+
+
+    def allow(self):
+        if self.opened is None:
+            return True
+        elif (not self._trial) and ((time.time() - self.opened) >= self.cooldown):
+            self._trial = True
+            return True
+        else:
+            return False
+
+
+    def end_trial(self):
+        # Let another trial call through if this one never reported back
+        self._trial = False
+
+
+    def success(self):
+        self.failures = 0
+        self.opened = None
+        self._trial = False
+
+
+    def failure(self):
+        self.failures += 1
+        if self._trial or (self.failures >= self.threshold):
+            if self.opened is None:
+                log.warning(f"Captcha provider failed {self.failures} times in a row, opening circuit breaker")
+            self.opened = time.time()
+            self._trial = False
+
+
+class CaptchaVerifier:
+    def __init__(self):
+        self.provider = os.getenv("CAPTCHA_PROVIDER", None)
+        self.url = os.getenv("CAPTCHA_URL", PROVIDER_URLS.get(self.provider))
+        self.fail_open = (os.getenv("CAPTCHA_FAIL_OPEN", "false").lower() == "true")
+        self.breaker = CircuitBreaker(
+            int(os.getenv("CAPTCHA_BREAKER_THRESHOLD", 5)),
+            float(os.getenv("CAPTCHA_BREAKER_COOLDOWN", 30))
+        )
+        self.counts = {"passed": 0, "rejected": 0, "errors": 0, "short_circuited": 0}
+        self._client = None
+
+        if (self.provider is not None) and (self.url is None):
+            raise ValueError(f"Unknown captcha provider: {self.provider}")
+
+
+    def client(self):
+        # Created on first use so it belongs to the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout = httpx.Timeout(float(os.getenv("CAPTCHA_TIMEOUT", 3)), connect = float(os.getenv("CAPTCHA_CONNECT_TIMEOUT", 1))),
+                limits = httpx.Limits(
+                    max_connections = int(os.getenv("CAPTCHA_MAX_CONNECTIONS", 20)),
+                    max_keepalive_connections = int(os.getenv("CAPTCHA_MAX_CONNECTIONS", 20))
+                )
+            )
+        return self._client
+
+
+    async def verify(self, token:str):
+        if self.provider is None:
+            log.warning("No captcha provider set! Please set one to help stop bots.")
+            return True
+
+        # Settle by the fail policy while the provider is failing
+        if not self.breaker.allow():
+            self.counts["short_circuited"] += 1
+            return self.fail_open
+
+        # Calls let through while the breaker is open are its trial
+        trial = (self.breaker.opened is not None)
+        try:
+            with span("captcha"):
+                resp = await self.client().post(self.url, data = {
+                    "secret": os.getenv("CAPTCHA_SECRET"),
+                    "response": token
+                })
+            if resp.status_code >= 500:
+                raise httpx.HTTPStatusError(f"Captcha provider returned {resp.status_code}", request = resp.request, response = resp)
+            passed = False
+            if resp.status_code == 200:
+                # An answer that isn't a JSON object counts as a provider failure
+                body = resp.json()
+                if not isinstance(body, dict):
+                    raise TypeError(f"Captcha provider returned {type(body).__name__} instead of an object")
+                passed = (body.get("success") is True)
+        except (httpx.HTTPError, ValueError, TypeError) as err:
+            self.counts["errors"] += 1
+            self.breaker.failure()
+            log.error(f"Failed to verify captcha: {type(err).__name__}: {str(err)}")
+            return self.fail_open
+        finally:
+            # A cancelled trial must not leave the breaker waiting on it forever
+            if trial:
+                self.breaker.end_trial()
+
+        self.breaker.success()
+        self.counts["passed" if passed else "rejected"] += 1
+        return passed
+
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+verifier = CaptchaVerifier()
+metrics.register("captcha_verifications_total", "counter", "Captcha verifications by result", lambda: {
+    (result,): count for result, count in verifier.counts.items()
+}, ("result",))
+metrics.register("captcha_breaker_state", "gauge", "Captcha circuit breaker state (1 for the current one)", lambda: {
+    (state,): int(verifier.breaker.state == state) for state in ["closed", "half_open", "open"]
+}, ("state",))
+
+
+async def check_captcha(token:str):
+    return await verifier.verify(token)
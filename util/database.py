@@ -1,11 +1,41 @@
 from util.supporter import log
-from pymongo import MongoClient
+from util.schema import migrate, build_indexes
+from util.queries import QUERIES
+from util.timing import span
+from util import metrics
+from pymongo import MongoClient, AsyncMongoClient, WriteConcern
 from redis import Redis
+from redis.asyncio import Redis as AsyncRedis, ConnectionPool as AsyncConnectionPool
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import namedtuple
+from threading import Thread, Lock, local
+import asyncio
+import json
 import sqlite3
+import queue
 import os
 import time
 
 
+# Result of a statement run by the SQLite writer
+WriteResult = namedtuple("WriteResult", ["rowcount", "rows"])
+
+
+# Write concern for Mongo writes that must survive a failover
+MAJORITY = WriteConcern(w = "majority", wtimeout = 5000)
+
+
+def _settle(future:Future, results:list = None, error:Exception = None):
+    # A future that can't take its result must never stop the writer
+    try:
+        if error is None:
+            future.set_result(results)
+        else:
+            future.set_exception(error)
+    except Exception as err:
+        log.error(f"Failed to settle write job: {str(err)}")
+
+
 class Database:
     def __init__(self):
         # Initialize Mongo database connection
@@ -16,6 +46,12 @@ class Database:
             )
             self.mongo = mongo_client[os.getenv("MONGODB_NAME", "meowerserver")]
             self.mongo.command("ping")
+
+            # Async client for request handlers, the sync one is kept for background threads
+            self.amongo = AsyncMongoClient(
+                os.getenv("MONGODB_URI", "mongodb://localhost:27017"),
+                serverSelectionTimeoutMS = int(os.getenv("MONGODB_TIMEOUT", 30))
+            )[os.getenv("MONGODB_NAME", "meowerserver")]
             log.success("MongoDB Connected!")
         except Exception as err:
             log.error(f"MongoDB failed to connect: {str(err)}")
@@ -30,15 +66,35 @@ class Database:
                 password = os.getenv("REDIS_PASSWORD", None),
                 db = int(os.getenv("REDIS_DB", 0))
             )
+
+            # Async client for request handlers, the sync one is kept for background threads
+            self.aredis = AsyncRedis(connection_pool = AsyncConnectionPool(
+                host = os.getenv("REDIS_HOST", "localhost"),
+                port = int(os.getenv("REDIS_PORT", 6379)),
+                username = os.getenv("REDIS_USERNAME", None),
+                password = os.getenv("REDIS_PASSWORD", None),
+                db = int(os.getenv("REDIS_DB", 0)),
+                max_connections = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+            ))
             log.success("Redis Connected!")
         except Exception as error:
             log.error(f"Redis failed to connect: {str(err)}")
             exit()
 
-        # Initialize SQLite persistent database connection
+        # Initialize SQLite persistent database in WAL mode, so readers don't block behind the writer
         try:
-            self.con = sqlite3.connect(os.environ.get("DB", "meowerauth.db"))
-            self.cur = self.con.cursor()
+            self.path = os.environ.get("DB", "meowerauth.db")
+            self._readers = local()
+            self._read_executor = ThreadPoolExecutor(max_workers = int(os.getenv("SQLITE_READERS", 8)), thread_name_prefix = "sqlite-reader")
+            self._write_queue = queue.Queue()
+            self.write_pause = Lock()
+            con = sqlite3.connect(self.path)
+            con.execute("PRAGMA auto_vacuum = INCREMENTAL")  # Only applies to new databases, lets the sweeper give free pages back
+            con.execute("PRAGMA journal_mode = WAL").fetchone()
+            migrate(con)
+            con.close()
+            self._writer_thread = Thread(target = self._writer, daemon = True)
+            self._writer_thread.start()
             log.success("SQLite Connected!")
         except Exception as err:
             log.error(f"SQLite failed to connect: {str(err)}")
@@ -46,13 +102,199 @@ class Database:
 
         # Initialize SQLite in-memory database connection
         try:
-            self.mem = sqlite3.connect("file::memory:?cache=shared").cursor()
+            # Shared by the request handlers and the cleanup thread, use it while holding mem_lock
+            self.mem = sqlite3.connect("file::memory:?cache=shared", isolation_level = None, check_same_thread = False).cursor()
+            self.mem_lock = Lock()
+            self._setup_memory()
             log.success("Memory DB Connected!")
         except Exception as err:
             log.error(f"Memory DB failed to connect: {str(err)}")
             exit()
 
 
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout = 30, isolation_level = None)
+        con.execute(f"PRAGMA synchronous = {os.getenv('SQLITE_SYNCHRONOUS', 'FULL')}")
+        return con
+
+
+    def _reader(self):
+        # Every thread gets its own read-only connection
+        con = getattr(self._readers, "con", None)
+        if con is None:
+            con = self._connect()
+            con.execute("PRAGMA query_only = ON")
+            self._readers.con = con
+        return con
+
+
+    def fetchone(self, query:str, params:tuple = ()):
+        return self._reader().execute(query, params).fetchone()
+
+
+    def fetchall(self, query:str, params:tuple = ()):
+        return self._reader().execute(query, params).fetchall()
+
+
+    async def afetchone(self, query:str, params:tuple = ()):
+        with span("sqlite_read"):
+            return await asyncio.get_running_loop().run_in_executor(self._read_executor, self.fetchone, query, params)
+
+
+    async def afetchall(self, query:str, params:tuple = ()):
+        with span("sqlite_read"):
+            return await asyncio.get_running_loop().run_in_executor(self._read_executor, self.fetchall, query, params)
+
+
+    def submit(self, statements:list):
+        """
+        Queue statements to be run atomically by the writer.
+
+        Statements are (query, params) tuples, or (query, params, True)
+        to run the query once for every set of params.
+
+        Returns a future that resolves to a WriteResult per statement
+        once the statements have been committed.
+        """
+
+        future = Future()
+        self._write_queue.put((statements, future))
+        return future
+
+
+    def write(self, query:str, params:tuple = ()):
+        """
+        Run a statement on the writer and wait for it to be committed.
+        """
+
+        return self.submit([(query, params)]).result()[0]
+
+
+    def write_many(self, query:str, params:list):
+        """
+        Run a statement for every set of params on the writer and wait for it to be committed.
+        """
+
+        return self.submit([(query, params, True)]).result()[0]
+
+
+    def transaction(self, statements:list):
+        """
+        Run statements atomically on the writer and wait for them to be committed.
+        """
+
+        return self.submit(statements).result()
+
+
+    async def awrite(self, query:str, params:tuple = ()):
+        with span("sqlite_write"):
+            return (await asyncio.wrap_future(self.submit([(query, params)])))[0]
+
+
+    async def awrite_many(self, query:str, params:list):
+        with span("sqlite_write"):
+            return (await asyncio.wrap_future(self.submit([(query, params, True)])))[0]
+
+
+    async def atransaction(self, statements:list):
+        with span("sqlite_write"):
+            return await asyncio.wrap_future(self.submit(statements))
+
+
+    def _run_batch(self, con:sqlite3.Connection, jobs:list):
+        # Run every job in one transaction
+        batch_started = time.perf_counter()
+        metrics.inc("sqlite_write_jobs_total", (), len(jobs))
+        finished = []
+        try:
+            con.execute("BEGIN IMMEDIATE")
+        except Exception as err:
+            for statements, future in jobs:
+                _settle(future, error = err)
+            return
+        for statements, future in jobs:
+            con.execute("SAVEPOINT job")
+            try:
+                results = []
+                for statement in statements:
+                    if (len(statement) > 2) and statement[2]:
+                        cur = con.executemany(statement[0], statement[1])
+                    else:
+                        cur = con.execute(statement[0], statement[1])
+                    rows = cur.fetchall()
+                    results.append(WriteResult(cur.rowcount, rows))
+                con.execute("RELEASE job")
+                finished.append((future, results))
+            except Exception as err:
+                con.execute("ROLLBACK TO job")
+                con.execute("RELEASE job")
+                _settle(future, error = err)
+
+        # Commit once for the whole group
+        try:
+            started = time.perf_counter()
+            con.execute("COMMIT")
+            metrics.observe("sqlite_commit_seconds", (time.perf_counter() - started))
+            metrics.observe("sqlite_write_batch_seconds", (time.perf_counter() - batch_started))
+        except Exception as err:
+            con.execute("ROLLBACK")
+            for future, results in finished:
+                _settle(future, error = err)
+            return
+        for future, results in finished:
+            _settle(future, results)
+
+
+    def _writer(self):
+        """
+        Runs every write on one connection. Whatever is queued while a
+        commit is in progress gets committed together in the next
+        transaction, each job in its own savepoint so a failing job
+        doesn't affect the others.
+        """
+
+        con = self._connect()
+        max_batch = int(os.getenv("SQLITE_MAX_BATCH", 256))
+
+        while True:
+            # Wait for a job and gather whatever else is waiting
+            jobs = [self._write_queue.get()]
+            while len(jobs) < max_batch:
+                try:
+                    jobs.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Stop after this group if the database is being closed
+            stopping = (None in jobs)
+
+            # Skip jobs whose caller gave up on them, the rest can't be cancelled anymore
+            jobs = [job for job in jobs if (job is not None) and job[1].set_running_or_notify_cancel()]
+            if len(jobs) == 0:
+                if stopping:
+                    break
+                continue
+
+            # Index builds pause the writer, they hold the write lock for longer than the busy timeout
+            with self.write_pause:
+                self._run_batch(con, jobs)
+
+            if stopping:
+                break
+
+        con.close()
+
+
+    def close(self):
+        """
+        Commit any queued writes and stop the writer.
+        """
+
+        self._write_queue.put(None)
+        self._writer_thread.join()
+        self._read_executor.shutdown(wait = False)
+
+
     def _setup_mongo(self):
         # Create users collection
         if "users" not in self.mongo.list_collection_names():
@@ -70,159 +312,135 @@ class Database:
                 self.mongo.sessions.create_index(index_name)
 
 
-    def _setup_sqlite(self):
-        # Attempt to create the accounts table
-        try:
-            self.cur.execute("""
-                CREATE TABLE accounts (
-                    id TEXT NOT NULL UNIQUE PRIMARY KEY,
-                    username TEXT NOT NULL UNIQUE,
-                    email TEXT UNIQUE,
-                    password TEXT,
-                    webauthn TEXT NOT NULL,
-                    totp_secret TEXT NOT NULL,
-                    mfa_recovery TEXT NOT NULL,
-                    lock_status INTEGER NOT NULL
-                )
-            """)
-            self.cur.execute("""
-                CREATE INDEX account_id ON accounts (
-                    id
-                )
-            """)
-            self.cur.execute("""
-                CREATE INDEX account_username ON accounts (
-                    username
-                )
-            """)
-            self.cur.execute("""
-                CREATE INDEX account_email ON accounts (
-                    email
-                )
-            """)
-            log.success("Created 'accounts' table")
-        except Exception as err:
-            log.error(f"Error making 'accounts' table: {str(err)}")
+    def _setup_memory(self):
+        # Create the mfa table
+        self.mem.execute("""
+            CREATE TABLE IF NOT EXISTS mfa (
+                id TEXT NOT NULL PRIMARY KEY,
+                user TEXT NOT NULL,
+                expires REAL NOT NULL
+            )
+        """)
+    
 
-        # Attempt to create the sessions table
-        try:
-            self.cur.execute("""
-                CREATE TABLE sessions (
-                    id TEXT NOT NULL UNIQUE PRIMARY KEY,
-                    auth_hash TEXT NOT NULL UNIQUE,
-                    main_hash TEXT NOT NULL UNIQUE,
-                    user TEXT NOT NULL,
-                    client TEXT NOT NULL,
-                    refreshed REAL NOT NULL,
-                    expires REAL NOT NULL
-                )
-            """)
-            self.cur.execute("""
-                CREATE INDEX session_id ON sessions (
-                    id
-                )
-            """)
-            self.cur.execute("""
-                CREATE INDEX session_token ON sessions (
-                    token
-                )
-            """)
-            self.cur.execute("""
-                CREATE INDEX session_user ON sessions (
-                    user
-                )
-            """)
-            log.success("Created 'sessions' table")
-        except Exception as err:
-            log.error(f"Error making 'sessions' table: {str(err)}")
+    def sweep_expired(self):
+        """
+        Delete expired sessions and email links in small batches, each
+        batch is its own job on the writer and the sweeper pauses
+        between batches so requests never wait long behind it.
 
-        # Attempt to create the email links table
-        try:
-            self.cur.execute("""
-                CREATE TABLE email_links (
-                    id TEXT NOT NULL UNIQUE PRIMARY KEY,
-                    user TEXT NOT NULL,
-                    email TEXT NOT NULL,
-                    action TEXT NOT NULL,
-                    expires INTEGER NOT NULL
-                )
-            """)
-            self.cur.execute("""
-                CREATE INDEX email_link_id ON email_links (
-                    id
-                )
-            """)
-            log.success("Created 'email_links' table")
-        except Exception as err:
-            log.error(f"Error making 'email_links' table: {str(err)}")
+        Returns the amount of rows deleted from each table.
+        """
 
-        # Attempt to create the logs table
-        try:
-            self.cur.execute("""
-                CREATE TABLE logs (
-                    id TEXT NOT NULL UNIQUE PRIMARY KEY,
-                    timestamp INTEGER NOT NULL,
-                    action TEXT NOT NULL,
-                    details TEXT NOT NULL,
-                    user TEXT,
-                    email TEXT,
-                    ip TEXT
-                )
-            """)
-            log.success("Created 'logs' table")
-        except Exception as err:
-            log.error(f"Error making 'logs' table: {str(err)}")
+        batch_size = int(os.getenv("SWEEP_BATCH_SIZE", 500))
+        pause = float(os.getenv("SWEEP_PAUSE", 0.05))
+
+        reclaimed = {}
+        for table in ["sessions", "email_links"]:
+            reclaimed[table] = 0
+            while True:
+                deleted = self.write(QUERIES[f"sweep_{table}"], (time.time(), batch_size)).rowcount
+                reclaimed[table] += deleted
+                if deleted < batch_size:
+                    break
+                time.sleep(pause)
 
-        # Attempt to create the ratelimits table
+        return reclaimed
+
+
+    def vacuum(self, pages:int):
+        """
+        Give up to `pages` free pages back to the filesystem.
+
+        Returns the amount of pages freed.
+        """
+
+        # sqlite3 only steps a statement without rows once, which would free a
+        # single page, executescript steps it until it's done
+        con = self._connect()
         try:
-            db.mem.execute("""
-                CREATE TABLE ratelimits (
-                    id TEXT NOT NULL PRIMARY KEY,
-                    remaining INTEGER NOT NULL,
-                    reset REAL NOT NULL
-                )
-            """)
-            log.success("Created 'ratelimits' table")
-        except Exception as err:
-            log.error(f"Error making 'ratelimits' table: {str(err)}")
-            exit()
-        
-        # Attempt to create the mfa table (in-memory)
+            free_pages = con.execute("PRAGMA freelist_count").fetchone()[0]
+            con.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+            return (free_pages - con.execute("PRAGMA freelist_count").fetchone()[0])
+        finally:
+            con.close()
+
+
+    def build_indexes(self):
+        """
+        Build the indexes migrations recorded but didn't build yet.
+        """
+
         try:
-            db.mem.execute("""
-                CREATE TABLE mfa (
-                    id TEXT NOT NULL PRIMARY KEY,
-                    user TEXT NOT NULL,
-                    expires REAL NOT NULL
-                )
-            """)
-            log.success("Created 'mfa' table")
+            con = self._connect()
+            try:
+                build_indexes(con, self.write_pause)
+            finally:
+                con.close()
         except Exception as err:
-            log.error(f"Error making 'mfa' table: {str(err)}")
-            exit()
-    
+            log.error(f"Failed to build indexes: {str(err)}")
+
 
     def background_cleanup(db):
+        vacuum_interval = int(os.getenv("SQLITE_VACUUM_INTERVAL", 0))
+        last_vacuum = time.time()
+
         while True:
             time.sleep(60)
 
-            db.mem.execute("DELETE FROM ratelimits WHERE reset <= ?", (time.time(),))
-            db.mem.execute("DELETE FROM mfa WHERE expires <= ?", (time.time(),))
-
-            users_to_purge = db.cur.execute("SELECT id FROM pending_deletion WHERE after <= ?", (time.time(),)).fetchall()
-            for row in users_to_purge:
-                userid = row[0]
-                db.mongo.users.update_one({"_id": userid}, {"$set": {
-                    "username": f"Deleted-{userid}",
-                    "username_lower": f"deleted-{userid}",
-                    "flags": 0,
-                    "admin": 0,
-                    "config": 0,
-                    "custom_theme": {},
-                    "quote": ""
-                }}, {"writeConcern": {"w": "majority", "wtimeout": 5000}})
-                db.cur.execute("DELETE FROM accounts WHERE id = ?", (userid,))
-                db.con.commit()
+            try:
+                with db.mem_lock:
+                    db.mem.execute("DELETE FROM mfa WHERE expires <= ?", (time.time(),))
+            except Exception as err:
+                log.error(f"Failed to clean up memory DB: {str(err)}")
+
+            # Sweep expired sessions and email links
+            try:
+                reclaimed = db.sweep_expired()
+                if sum(reclaimed.values()) > 0:
+                    log.info(f"Swept {reclaimed['sessions']} expired sessions and {reclaimed['email_links']} expired email links")
+            except Exception as err:
+                log.error(f"Failed to sweep expired rows: {str(err)}")
+
+            # Give free pages back to the filesystem
+            if (vacuum_interval > 0) and ((time.time() - last_vacuum) >= vacuum_interval):
+                last_vacuum = time.time()
+                try:
+                    if db.fetchone("PRAGMA auto_vacuum")[0] == 2:
+                        freed = db.vacuum(int(os.getenv("SQLITE_VACUUM_PAGES", 1000)))
+                        if freed > 0:
+                            log.info(f"Gave {freed} free pages back to the filesystem")
+                    else:
+                        log.warning("Skipping incremental vacuum, the database was not created with auto_vacuum = INCREMENTAL")
+                except Exception as err:
+                    log.error(f"Failed to vacuum database: {str(err)}")
+
+            try:
+                users_to_purge = db.fetchall(QUERIES["due_account_deletions"], (time.time(),))
+                for row in users_to_purge:
+                    userid = row[0]
+                    db.mongo.users.with_options(write_concern = MAJORITY).update_one({"_id": userid}, {"$set": {
+                        "username": f"Deleted-{userid}",
+                        "username_lower": f"deleted-{userid}",
+                        "flags": 0,
+                        "admin": 0,
+                        "config": 0,
+                        "custom_theme": {},
+                        "quote": ""
+                    }})
+                    db.transaction([
+                        (QUERIES["delete_account"], (userid,)),
+                        (QUERIES["remove_user_totp"], (userid,)),
+                        (QUERIES["remove_recovery_codes"], (userid,)),
+                        (QUERIES["remove_pending_deletion"], (userid,))
+                    ])
+                    db.redis.publish(os.getenv("REDIS_CHANNEL", "org.meower"), json.dumps({"op": "update_account", "val": userid}))
+            except Exception as err:
+                log.error(f"Failed to purge deleted accounts: {str(err)}")
 
 
 db = Database()
+metrics.describe("sqlite_commit_seconds", "histogram", "Latency of SQLite commits")
+metrics.describe("sqlite_write_batch_seconds", "histogram", "Time the writer spends on a group of write jobs, including the commit")
+metrics.describe("sqlite_write_jobs_total", "counter", "Write jobs run by the writer")
+metrics.register("sqlite_write_queue_depth", "gauge", "Write jobs waiting for the writer", lambda: db._write_queue.qsize())
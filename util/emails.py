@@ -1,3 +1,5 @@
+from util.supporter import log
+from util import metrics
 from jinja2 import Template
 from threading import Thread
 import os
@@ -26,6 +28,18 @@ TEMPLATES = {
 }
 
 
+metrics.describe("emails_total", "counter", "Emails by template and outcome", ("template", "outcome"))
+
+
+def _post_email(template_name:str, url:str, **kwargs):
+    try:
+        resp = requests.post(url, **kwargs)
+        metrics.inc("emails_total", (template_name, ("sent" if resp.ok else "rejected")))
+    except Exception as err:
+        metrics.inc("emails_total", (template_name, "failed"))
+        log.error(f"Failed to send {template_name} email: {str(err)}")
+
+
 def send_email(email:str, template:str, fields:dict, token:str = None):
     if email is None:
         return
@@ -35,6 +49,7 @@ def send_email(email:str, template:str, fields:dict, token:str = None):
         raise FileNotFoundError
 
     # Get template information
+    template_name = template
     template = TEMPLATES[template]
     
     # Make sure all fields are set
@@ -52,8 +67,9 @@ def send_email(email:str, template:str, fields:dict, token:str = None):
     mail_provider = os.getenv("EMAIL_PROVIDER", "mailchannels")
     if mail_provider == "mailchannels":
         # Create and start thread for worker request
-        Thread(target=requests.post,
+        Thread(target=_post_email,
             args=(
+                template_name,
                 os.getenv("EMAIL_WORKER_URL", "email-worker.meower.org"),
             ),
             kwargs={
@@ -69,4 +85,5 @@ def send_email(email:str, template:str, fields:dict, token:str = None):
             }
         ).start()
     elif mail_provider == "smtp":
-        pass # TODO: Add SMTP support
+        # TODO: Add SMTP support
+        metrics.inc("emails_total", (template_name, "unsupported"))
@@ -0,0 +1,188 @@
+from util.supporter import log
+import tempfile
+import sqlite3
+import shutil
+import gzip
+import time
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+"""
+Logs partitioned into one SQLite file per day (UTC).
+
+Logs live in their own files so they don't share a write lock and page
+cache with the accounts and sessions in the main database. Expired days
+are dropped by deleting their file, and days that are no longer written
+to are compressed into gzip archives (logs-YYYY-MM-DD.db.gz), which can
+be decompressed and opened with sqlite3 when the logs need reviewing.
+
+Every worker writes to the partitions of the current day. Maintenance
+takes an fcntl lock on the directory, so only one worker expires and
+compresses partitions at a time and the others skip that round.
+
+Config:
+* LOG_DIR - directory the partitions are kept in
+* LOG_RETENTION_DAYS - days logs are kept for
+* LOG_COMPRESS_AFTER_DAYS - days after which a partition is compressed (at least 1)
+"""
+
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS logs (
+        id TEXT NOT NULL UNIQUE PRIMARY KEY,
+        timestamp INTEGER NOT NULL,
+        action TEXT NOT NULL,
+        details TEXT NOT NULL,
+        user TEXT,
+        email TEXT,
+        ip TEXT
+    )
+"""
+
+
+# Logs already in a partition are skipped, so moving a log twice is harmless
+INSERT_LOG = "INSERT OR IGNORE INTO logs (id, timestamp, action, details, user, email, ip) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+
+def _day(timestamp:float):
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+
+class LogPartitions:
+    def __init__(self, directory:str = None, retention_days:int = None, compress_after_days:int = None):
+        self.directory = (directory or os.getenv("LOG_DIR", "logs"))
+        self.retention_days = (retention_days or int(os.getenv("LOG_RETENTION_DAYS", 90)))
+        self.compress_after_days = max(1, (compress_after_days or int(os.getenv("LOG_COMPRESS_AFTER_DAYS", 2))))
+        self._connections = {}
+
+        os.makedirs(self.directory, exist_ok = True)
+
+
+    def path(self, day:str):
+        return os.path.join(self.directory, f"logs-{day}.db")
+
+
+    def _connect(self, day:str):
+        con = self._connections.get(day)
+        if con is None:
+            con = sqlite3.connect(self.path(day), timeout = 30, isolation_level = None, check_same_thread = False)
+            con.execute("PRAGMA journal_mode = WAL").fetchone()
+            con.execute("PRAGMA synchronous = NORMAL")
+            con.execute(SCHEMA)
+            self._connections[day] = con
+        return con
+
+
+    def write(self, rows:list):
+        """
+        Write log rows to the partitions of their days, one transaction per partition.
+        """
+
+        days = {}
+        for row in rows:
+            days.setdefault(_day(row[1]), []).append(row)
+
+        for day, day_rows in days.items():
+            con = self._connect(day)
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                con.executemany(INSERT_LOG, day_rows)
+                con.execute("COMMIT")
+            except:
+                con.execute("ROLLBACK")
+                raise
+
+        # Only keep the partitions that are still being written to open
+        for day in list(self._connections):
+            if day not in days:
+                self._connections.pop(day).close()
+
+
+    def partitions(self):
+        """
+        Get the (day, path) of every partition and archive, oldest first.
+        """
+
+        partitions = []
+        for name in os.listdir(self.directory):
+            if name.startswith("logs-") and (name.endswith(".db") or name.endswith(".gz")):
+                partitions.append((name[5:15], os.path.join(self.directory, name)))
+        return sorted(partitions)
+
+
+    def _compress(self, day:str):
+        path = self.path(day)
+        if not os.path.exists(path):
+            return
+
+        # Fold the WAL back into the file so the archive is one self-contained database
+        con = sqlite3.connect(f"file:{path}?mode=rw", uri = True)
+        con.execute("PRAGMA journal_mode = DELETE").fetchone()
+        con.close()
+
+        # Logs written to a day after it was archived get an archive of their own
+        archive = f"{path}.gz"
+        number = 1
+        while os.path.exists(archive):
+            archive = os.path.join(self.directory, f"logs-{day}.{number}.db.gz")
+            number += 1
+
+        fd, tmp_path = tempfile.mkstemp(prefix = f"logs-{day}.", suffix = ".gz.tmp", dir = self.directory)
+        try:
+            with open(path, "rb") as src, gzip.open(os.fdopen(fd, "wb"), "wb", compresslevel = 6) as dst:
+                shutil.copyfileobj(src, dst, (1024 * 1024))
+            os.replace(tmp_path, archive)
+        except:
+            os.unlink(tmp_path)
+            raise
+        os.unlink(path)
+
+
+    def maintain(self, now:float = None):
+        """
+        Delete expired partitions and compress the ones that are no longer written to.
+        """
+
+        # Only one worker maintains the partitions at a time, the others skip this round
+        lock_fd = os.open(os.path.join(self.directory, ".maintenance.lock"), (os.O_RDWR | os.O_CREAT))
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_fd, (fcntl.LOCK_EX | fcntl.LOCK_NB))
+                except BlockingIOError:
+                    return
+
+            # Clean up after compressions that were interrupted
+            for name in os.listdir(self.directory):
+                if name.endswith(".gz.tmp"):
+                    os.unlink(os.path.join(self.directory, name))
+
+            now = (now or time.time())
+            expired = _day(now - (self.retention_days * 86400))
+            cold = _day(now - (self.compress_after_days * 86400))
+            for day, path in self.partitions():
+                if day in self._connections:
+                    continue
+                try:
+                    if day < expired:
+                        for suffix in ["", "-wal", "-shm"]:
+                            if os.path.exists(path + suffix):
+                                os.unlink(path + suffix)
+                    elif (day <= cold) and path.endswith(".db"):
+                        self._compress(day)
+                except Exception as err:
+                    log.error(f"Failed to maintain log partition {day}: {str(err)}")
+        finally:
+            # Closing the file releases the lock
+            os.close(lock_fd)
+
+
+    def close(self):
+        for con in self._connections.values():
+            con.close()
+        self._connections.clear()
@@ -0,0 +1,177 @@
+from threading import Lock, local, current_thread
+from bisect import bisect_left
+import weakref
+import math
+
+
+"""
+Prometheus-style metrics of this worker.
+
+Counters and histograms are updated in a shard owned by the updating
+thread, so updates never take a lock. Scraping adds up the shards of
+every thread, and folds the shards of threads that have finished into
+one so short-lived threads don't pile up.
+
+Values that already live somewhere else (queue depths, cache hit counts)
+are registered as callbacks and read on scrape.
+
+Every worker process keeps its own metrics, scrape each of them.
+"""
+
+
+# Latency buckets in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# Name -> (type, help, label names)
+_metrics = {}
+
+# Name -> (type, help, label names, callback)
+_callbacks = {}
+
+# Shards of live threads as (thread weakref, shard), shards are {(name, label values): value}
+_shards = []
+_retired = {}
+_shards_lock = Lock()
+_local = local()
+
+
+def describe(name:str, type:str, help:str, labels:tuple = ()):
+    """
+    Declare a counter or histogram.
+    """
+
+    _metrics[name] = (type, help, labels)
+
+
+def register(name:str, type:str, help:str, callback, labels:tuple = ()):
+    """
+    Declare a counter or gauge that's read from a callback on scrape.
+
+    The callback returns a number, or a dict of label values -> number if the metric has labels.
+    """
+
+    _callbacks[name] = (type, help, labels, callback)
+
+
+def _shard():
+    try:
+        return _local.shard
+    except AttributeError:
+        shard = _local.shard = {}
+        with _shards_lock:
+            _shards.append((weakref.ref(current_thread()), shard))
+        return shard
+
+
+def inc(name:str, labels:tuple = (), value:float = 1):
+    """
+    Increment a counter.
+    """
+
+    shard = _shard()
+    key = (name, labels)
+    shard[key] = (shard.get(key, 0) + value)
+
+
+def observe(name:str, value:float, labels:tuple = ()):
+    """
+    Add a value to a histogram.
+    """
+
+    shard = _shard()
+    key = (name, labels)
+    counts = shard.get(key)
+    if counts is None:
+        # One count per bucket, then +Inf, then the sum
+        counts = shard[key] = ([0] * (len(BUCKETS) + 2))
+    counts[bisect_left(BUCKETS, value)] += 1
+    counts[-1] += value
+
+
+def _merge(into:dict, shard:dict):
+    for key, value in shard.items():
+        if isinstance(value, list):
+            if key in into:
+                into[key] = [(a + b) for a, b in zip(into[key], value)]
+            else:
+                into[key] = list(value)
+        else:
+            into[key] = (into.get(key, 0) + value)
+
+
+def collect():
+    """
+    Add up the shards of every thread.
+    """
+
+    with _shards_lock:
+        # Fold the shards of finished threads, nothing writes to them anymore
+        live = []
+        for thread, shard in _shards:
+            if (thread() is None) or (not thread().is_alive()):
+                _merge(_retired, dict(shard))
+            else:
+                live.append((thread, shard))
+        _shards[:] = live
+
+        totals = {}
+        _merge(totals, _retired)
+        for thread, shard in live:
+            # Copying a dict is atomic, the owning thread may still be writing to it
+            _merge(totals, dict(shard))
+
+    return totals
+
+
+def _format_labels(names:tuple, values:tuple, le:float = None):
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    if le is not None:
+        pairs.append(f'le="{_format_value(le)}"')
+    return (("{" + ",".join(pairs) + "}") if len(pairs) > 0 else "")
+
+
+def _format_value(value:float):
+    if value == math.inf:
+        return "+Inf"
+    return (str(int(value)) if float(value).is_integer() else repr(float(value)))
+
+
+def render():
+    """
+    Get every metric in the Prometheus text format.
+    """
+
+    totals = {}
+    for (name, labels), value in collect().items():
+        totals.setdefault(name, {})[labels] = value
+
+    lines = []
+    for name, (type, help, label_names) in _metrics.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        for labels, value in sorted(totals.get(name, {}).items()):
+            if type == "histogram":
+                cumulative = 0
+                for bound, count in zip((*BUCKETS, math.inf), value[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(label_names, labels, bound)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(label_names, labels)} {_format_value(value[-1])}")
+                lines.append(f"{name}_count{_format_labels(label_names, labels)} {cumulative}")
+            else:
+                lines.append(f"{name}{_format_labels(label_names, labels)} {_format_value(value)}")
+
+    for name, (type, help, label_names, callback) in _callbacks.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        values = callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            if value is not None:
+                lines.append(f"{name}{_format_labels(label_names, labels)} {_format_value(value)}")
+
+    return ("\n".join(lines) + "\n")
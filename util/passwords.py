@@ -0,0 +1,232 @@
+from util.timing import span
+from util import metrics
+from fastapi import HTTPException
+from concurrent.futures import ProcessPoolExecutor
+from passlib.context import CryptContext
+import multiprocessing
+import asyncio
+import argparse
+import secrets
+import time
+import os
+
+
+"""
+Password hashing executor for the authentication server.
+
+Hashing and verifying passwords is deliberately slow, so it is done
+in a pool of worker processes instead of on the event loop. The amount
+of pending jobs is bounded, once the queue is full new jobs are
+rejected straight away instead of piling up behind a login storm.
+
+The pool is started with forkserver instead of fork: by the time it's
+created the server already runs threads (the SQLite writer, pub/sub
+listeners, ...), and forking a process with threads can leave a child
+stuck on a lock one of them held. Every server worker has its own pool,
+so by default the CPUs are split between the workers.
+
+New hashes use the scheme set by PASSWORD_SCHEME, hashes made with
+another scheme or older parameters still verify and get upgraded by
+the caller after a successful login.
+
+Config:
+* HASH_WORKERS - amount of worker processes (defaults to CPU count / WEB_CONCURRENCY)
+* WEB_CONCURRENCY - amount of server workers on this host (read by uvicorn too)
+* HASH_QUEUE_SIZE - maximum amount of pending jobs
+* PASSWORD_SCHEME - scheme for new hashes (argon2 or bcrypt)
+* SALT_STRENGTH - bcrypt cost factor
+* ARGON2_MEMORY_COST - argon2id memory in KiB
+* ARGON2_TIME_COST - argon2id iterations
+* ARGON2_PARALLELISM - argon2id lanes
+
+Run `python -m util.passwords` to pick parameters for this host.
+"""
+
+
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", max(1, ((os.cpu_count() or 1) // int(os.getenv("WEB_CONCURRENCY", 1))))))
+HASH_QUEUE_SIZE = int(os.getenv("HASH_QUEUE_SIZE", 64))
+
+
+# Process pool and amount of jobs currently queued or running
+executor = None
+pending_jobs = 0
+
+
+def build_policy(scheme:str = None, salt_strength:int = None, memory_cost:int = None, time_cost:int = None, parallelism:int = None):
+    """
+    Build the password hash policy, any unset parameter is read from the environment.
+    """
+
+    scheme = (scheme or os.getenv("PASSWORD_SCHEME", "bcrypt"))
+    if scheme not in ["argon2", "bcrypt"]:
+        raise ValueError(f"Unknown password scheme: {scheme}")
+
+    salt_strength = (salt_strength or int(os.getenv("SALT_STRENGTH", 14)))
+    time_cost = (time_cost or int(os.getenv("ARGON2_TIME_COST", 3)))
+
+    # Hashes with a cost below the current one are marked for upgrade
+    return CryptContext(
+        schemes = ["argon2", "bcrypt"],
+        default = scheme,
+        deprecated = "auto",
+        bcrypt__rounds = salt_strength,
+        bcrypt__min_rounds = salt_strength,
+        argon2__type = "ID",
+        argon2__memory_cost = (memory_cost or int(os.getenv("ARGON2_MEMORY_COST", 65536))),
+        argon2__rounds = time_cost,
+        argon2__min_rounds = time_cost,
+        argon2__parallelism = (parallelism or int(os.getenv("ARGON2_PARALLELISM", 1)))
+    )
+
+
+# Current password hash policy (worker processes build it from the same environment)
+policy = build_policy()
+
+
+def _hash(password:str):
+    return policy.hash(password)
+
+
+def _verify(password:str, password_hash:str):
+    return policy.verify_and_update(password, password_hash)
+
+
+def queue_depth():
+    """
+    Get the amount of hashing jobs that are currently queued or running.
+    """
+
+    return pending_jobs
+
+
+metrics.register("password_hash_queue_depth", "gauge", "Password hashing jobs queued or running", queue_depth)
+
+
+async def _submit(func, *args):
+    global executor, pending_jobs
+
+    # Reject the job if the queue is full
+    if pending_jobs >= HASH_QUEUE_SIZE:
+        raise HTTPException(status_code = 503, detail = "Server is busy, please try again later", headers = {"Retry-After": "1"})
+
+    # Create the process pool on first use
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers = HASH_WORKERS, mp_context = multiprocessing.get_context("forkserver"))
+
+    # Run job in the process pool
+    pending_jobs += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    finally:
+        pending_jobs -= 1
+
+
+async def hash_password(password:str):
+    """
+    Hash a password without blocking the event loop.
+    """
+
+    with span("password_hash"):
+        return await _submit(_hash, password)
+
+
+async def verify_password(password:str, password_hash:str):
+    """
+    Verify a password against a hash without blocking the event loop.
+
+    Returns a tuple of whether the password is valid and a new hash
+    if the stored one doesn't match the current policy.
+    """
+
+    with span("password_verify"):
+        return await _submit(_verify, password, password_hash)
+
+
+def shutdown():
+    """
+    Stop the process pool.
+    """
+
+    global executor
+
+    if executor is not None:
+        executor.shutdown(wait = False, cancel_futures = True)
+        executor = None
+
+
+def _p99_verify_ms(context:CryptContext, samples:int):
+    password = secrets.token_urlsafe(16)
+    password_hash = context.hash(password)
+
+    # Time verifications
+    timings = []
+    for i in range(samples):
+        start_time = time.perf_counter()
+        context.verify(password, password_hash)
+        timings.append((time.perf_counter() - start_time) * 1000)
+
+    # Return 99th percentile
+    timings.sort()
+    return timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+
+
+def calibrate(scheme:str, target_ms:float, samples:int, parallelism:int, max_memory_cost:int):
+    """
+    Benchmark this host and find the most expensive parameters that
+    still verify within the target p99 latency.
+    """
+
+    best = None
+    if scheme == "bcrypt":
+        for salt_strength in range(10, 20):
+            p99 = _p99_verify_ms(build_policy(scheme = "bcrypt", salt_strength = salt_strength), samples)
+            print(f"bcrypt rounds={salt_strength}: p99 {p99:.1f}ms")
+            if p99 > target_ms:
+                break
+            best = ({"PASSWORD_SCHEME": "bcrypt", "SALT_STRENGTH": salt_strength}, p99)
+    else:
+        # Use as much memory as possible first, then add iterations
+        memory_cost = 8192
+        time_cost = 1
+        while memory_cost <= max_memory_cost:
+            context = build_policy(scheme = "argon2", memory_cost = memory_cost, time_cost = time_cost, parallelism = parallelism)
+            p99 = _p99_verify_ms(context, samples)
+            print(f"argon2id m={memory_cost} t={time_cost} p={parallelism}: p99 {p99:.1f}ms")
+            if p99 > target_ms:
+                break
+            best = ({"PASSWORD_SCHEME": "argon2", "ARGON2_MEMORY_COST": memory_cost, "ARGON2_TIME_COST": time_cost, "ARGON2_PARALLELISM": parallelism}, p99)
+            memory_cost *= 2
+        if best is not None:
+            memory_cost = best[0]["ARGON2_MEMORY_COST"]
+            while True:
+                time_cost += 1
+                context = build_policy(scheme = "argon2", memory_cost = memory_cost, time_cost = time_cost, parallelism = parallelism)
+                p99 = _p99_verify_ms(context, samples)
+                print(f"argon2id m={memory_cost} t={time_cost} p={parallelism}: p99 {p99:.1f}ms")
+                if p99 > target_ms:
+                    break
+                best = ({"PASSWORD_SCHEME": "argon2", "ARGON2_MEMORY_COST": memory_cost, "ARGON2_TIME_COST": time_cost, "ARGON2_PARALLELISM": parallelism}, p99)
+
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Pick password hash parameters for this host.")
+    parser.add_argument("--scheme", choices = ["argon2", "bcrypt"], default = "argon2")
+    parser.add_argument("--target-ms", type = float, default = 250)
+    parser.add_argument("--samples", type = int, default = 20)
+    parser.add_argument("--parallelism", type = int, default = 1)
+    parser.add_argument("--max-memory", type = int, default = 1048576, help = "maximum argon2id memory cost in KiB")
+    args = parser.parse_args()
+
+    result = calibrate(args.scheme, args.target_ms, args.samples, args.parallelism, args.max_memory)
+    if result is None:
+        print(f"No parameters verify within {args.target_ms}ms on this host")
+        exit(1)
+
+    # Print environment variables and expected capacity
+    params, p99 = result
+    print()
+    for key, value in params.items():
+        print(f"{key}={value}")
+    print(f"# p99 {p99:.1f}ms, about {int(HASH_WORKERS * 1000 / p99)} logins/second with HASH_WORKERS={HASH_WORKERS}")
@@ -0,0 +1,99 @@
+from fastapi import HTTPException
+from threading import Lock, get_ident, enumerate as enumerate_threads
+from collections import Counter
+import sys
+import time
+import os
+
+
+"""
+On-demand sampling profiler for the current worker.
+
+Samples the stack of every thread with sys._current_frames() and counts
+them as collapsed stacks ("thread;module:function;... count" lines),
+which flamegraph.pl, speedscope and inferno read directly.
+
+Only one profile runs at a time and it's cut off after
+PROFILER_MAX_SECONDS. If taking samples uses more than
+PROFILER_MAX_OVERHEAD of the time, the interval is stretched to
+bring it back down.
+
+Config:
+* PROFILER_MAX_SECONDS - longest profile allowed
+* PROFILER_MAX_OVERHEAD - fraction of time sampling may take
+"""
+
+
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", 60))
+PROFILER_MAX_OVERHEAD = float(os.getenv("PROFILER_MAX_OVERHEAD", 0.02))
+
+
+_running = Lock()
+
+
+def _label(frame, labels:dict):
+    code = frame.f_code
+    label = labels.get(code)
+    if label is None:
+        label = labels[code] = f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}:{code.co_firstlineno}".replace(";", ":")
+    return label
+
+
+def sample(seconds:float, interval:float):
+    """
+    Sample the stacks of every other thread for some amount of seconds.
+
+    Returns a Counter of collapsed stack -> samples, and stats about the profile.
+    """
+
+    if not _running.acquire(blocking = False):
+        raise HTTPException(status_code = 409, detail = "A profile is already running")
+
+    try:
+        seconds = min(seconds, PROFILER_MAX_SECONDS)
+        own_ident = get_ident()
+        stacks = Counter()
+        labels = {}
+        samples = 0
+        sampling_time = 0
+        started = time.perf_counter()
+        deadline = (started + seconds)
+        while True:
+            sample_started = time.perf_counter()
+            if sample_started >= deadline:
+                break
+
+            names = {thread.ident: thread.name.replace(";", ":") for thread in enumerate_threads()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(_label(frame, labels))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+
+            # Stretch the interval if sampling is taking too much of the time
+            spent = (time.perf_counter() - sample_started)
+            sampling_time += spent
+            time.sleep(max(interval, (spent / PROFILER_MAX_OVERHEAD) - spent))
+    finally:
+        _running.release()
+
+    elapsed = (time.perf_counter() - started)
+    return stacks, {
+        "seconds": round(elapsed, 3),
+        "samples": samples,
+        "overhead": round((sampling_time / elapsed), 4) if elapsed > 0 else 0
+    }
+
+
+def collapse(stacks:Counter):
+    """
+    Get the collapsed stacks format of a profile, most sampled stacks first.
+    """
+
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
@@ -0,0 +1,59 @@
+"""
+Every SQL statement the server runs against the persistent SQLite
+database, by name.
+
+benchmarks/query_plans.py checks the plan of each of these against a
+large seeded database, so queries should be added here rather than
+written inline.
+"""
+
+
+QUERIES = {
+    # Accounts
+    "account_by_id": "SELECT id, username, email, password, webauthn, lock_status FROM accounts WHERE id = ?",
+    "account_by_username": "SELECT id, username, email, password, webauthn, lock_status FROM accounts WHERE username = ?",
+    "account_by_email": "SELECT id, username, email, password, webauthn, lock_status FROM accounts WHERE email = ?",
+    "create_account": "INSERT INTO accounts (id, username, email, password, webauthn, lock_status, totp_secret, mfa_recovery) VALUES (?, ?, ?, ?, ?, ?, '[]', '[]')",
+    "update_account_email": "UPDATE accounts SET email = ? WHERE id = ?",
+    "update_account_password": "UPDATE accounts SET password = ? WHERE id = ?",
+    "update_account_lock_status": "UPDATE accounts SET lock_status = ? WHERE id = ?",
+
+    # TOTP authenticators and recovery codes
+    "totp_by_user": "SELECT id, name, secret FROM totp_authenticators WHERE user = ?",
+    "add_totp": "INSERT INTO totp_authenticators VALUES (?, ?, ?, ?)",
+    "remove_totp": "DELETE FROM totp_authenticators WHERE id = ? AND user = ?",
+    "remove_user_totp": "DELETE FROM totp_authenticators WHERE user = ?",
+    "add_recovery_code": "INSERT INTO recovery_codes VALUES (?, ?)",
+    "remove_recovery_code": "DELETE FROM recovery_codes WHERE user = ? AND code_hash = ?",
+    "remove_recovery_codes": "DELETE FROM recovery_codes WHERE user = ?",
+    "count_recovery_codes": "SELECT COUNT(*) FROM recovery_codes WHERE user = ?",
+
+    # Sessions
+    "session_by_id": "SELECT * FROM sessions WHERE id = ?",
+    "session_by_auth_hash": "SELECT * FROM sessions WHERE auth_hash = ?",
+    "create_session": "INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)",
+    "refresh_session": "UPDATE sessions SET auth_hash = ?, main_hash = ?, refreshed = ?, expires = ? WHERE id = ?",
+    "delete_session": "DELETE FROM sessions WHERE id = ?",
+    "delete_user_sessions": "DELETE FROM sessions WHERE user = ? RETURNING main_hash",
+    "list_sessions": "SELECT id, client, refreshed FROM sessions WHERE user = ? ORDER BY refreshed DESC, id DESC LIMIT ?",
+    "list_sessions_after": "SELECT id, client, refreshed FROM sessions WHERE user = ? AND (refreshed, id) < (?, ?) ORDER BY refreshed DESC, id DESC LIMIT ?",
+    "introspect_sessions": """
+        SELECT sessions.main_hash, sessions.user, sessions.refreshed, accounts.lock_status
+        FROM sessions JOIN accounts ON accounts.id = sessions.user
+        WHERE sessions.main_hash IN (SELECT value FROM json_each(?))
+    """,
+
+    # Email links
+    "email_link_by_id": "SELECT * FROM email_links WHERE id = ?",
+    "create_email_link": "INSERT INTO email_links VALUES (?, ?, ?, ?, ?)",
+    "delete_email_link": "DELETE FROM email_links WHERE id = ?",
+
+    # Account deletion
+    "due_account_deletions": "SELECT id FROM pending_deletion WHERE after <= ?",
+    "delete_account": "DELETE FROM accounts WHERE id = ?",
+    "remove_pending_deletion": "DELETE FROM pending_deletion WHERE id = ?",
+
+    # Expired row sweeper
+    "sweep_sessions": "DELETE FROM sessions WHERE rowid IN (SELECT rowid FROM sessions WHERE expires <= ? LIMIT ?)",
+    "sweep_email_links": "DELETE FROM email_links WHERE rowid IN (SELECT rowid FROM email_links WHERE expires <= ? LIMIT ?)",
+}
@@ -1,114 +1,422 @@
 from util.supporter import log
-from util.database import db
+from util import metrics
 from fastapi import HTTPException
+from collections import namedtuple
+from threading import Thread, Lock
+from hashlib import blake2b
+import json
+import tempfile
+import struct
+import mmap
+import math
 import time
-import requests
 import os
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 """
 Ratelimits specifically for the authentication server.
 
-These ratelimits only use SQLite in-memory since the auth server
-doesn't have a fast connection to the Redis cluster and doesn't 
-need to be super fast. 
-
-The expired ratelimit entries get cleaned out every minute.
-
-
-Buckets:
-* global
-* registrations
-* failed_pswd
-* failed_webauthn
-* failed_mfa
-* reset_pswd
-* get_user
-* get_settings
-* update_email
-* update_pswd
-* update_webauthn
-* update_totp
-* get_sessions
+These ratelimits are kept in the memory of the process since the
+auth server doesn't have a fast connection to the Redis cluster.
+
+Every bucket is a GCRA (generic cell rate algorithm) limit of `limit`
+hits per `ttl` seconds, which only needs to store the time the next
+hit is allowed at. Entries expire once they are back at a full limit
+and are cleaned out lazily by a timer wheel.
+
+When running several workers, shared buckets are kept in a
+memory-mapped file every worker on the host uses instead, so limits
+aren't multiplied by the amount of workers.
+
+The limit of every bucket is set in DEFAULT_POLICIES and can be
+overridden by a JSON file of {"bucket": {"limit": 5, "ttl": 60,
+"shared": true}}, which is reloaded whenever it changes.
+
+Config:
+* RATELIMIT_POLICY_FILE - JSON file overriding bucket policies
+* RATELIMIT_POLICY_INTERVAL - seconds between checks of the policy file for changes
+* RATELIMIT_SHARED_BUCKETS - comma separated buckets to share between workers ("*" for all)
+* RATELIMIT_SHARED_PATH - file backing the shared ratelimits
+* RATELIMIT_SHARED_SLOTS - amount of ratelimits the shared file can hold
 """
 
 
-def check_captcha(token:str):
-    # Set captcha provider
-    captcha_provider = os.getenv("CAPTCHA_PROVIDER", None)
-    if captcha_provider is None:
-        log.warning("No captcha provider set! Please set one to help stop bots.")
-        return True
-    elif captcha_provider == "turnstile":
-        api_uri = "https://challenges.cloudflare.com/turnstile/v0/siteverify"
-    elif captcha_provider == "recaptcha":
-        api_uri = "https://www.google.com/recaptcha/api/siteverify"
-    elif captcha_provider == "hcaptcha":
-        api_uri = "https://hcaptcha.com/siteverify"
-
-    # Validate token with API
-    resp = requests.post(api_uri, data = {
-        "secret": os.getenv("CAPTCHA_SECRET"),
-        "response": token
-    })
-    if (resp.status_code == 200) and resp.json()["success"]:
-        return True
+# Limit of every bucket, `limit` hits per `ttl` seconds
+DEFAULT_POLICIES = {
+    "global": {"limit": 30, "ttl": 60},
+    "registrations": {"limit": 2, "ttl": 300},
+    "authentications": {"limit": 10, "ttl": 60},
+    "failed_pswd": {"limit": 5, "ttl": 60},
+    "failed_webauthn": {"limit": 5, "ttl": 60},
+    "failed_mfa": {"limit": 5, "ttl": 60},
+    "reset_pswd": {"limit": 2, "ttl": 300},
+    "get_user": {"limit": 60, "ttl": 60},
+    "get_settings": {"limit": 60, "ttl": 60},
+    "update_email": {"limit": 3, "ttl": 300},
+    "update_pswd": {"limit": 3, "ttl": 300},
+    "update_webauthn": {"limit": 5, "ttl": 60},
+    "update_totp": {"limit": 5, "ttl": 60},
+    "get_sessions": {"limit": 30, "ttl": 60}
+}
+
+
+# Status of a ratelimit, reset is the amount of seconds until the limit is full
+# again and retry_after the amount of seconds until the next hit is allowed
+RateLimitStatus = namedtuple("RateLimitStatus", ["allowed", "limit", "remaining", "reset", "retry_after"])
+
+
+# Compiled policy of a bucket
+Policy = namedtuple("Policy", ["limit", "ttl", "limiter"])
+
+
+def _status(tat:float, interval:float, ttl:float, now:float, allowed:bool):
+    limit = max(1, round(ttl / interval))
+    remaining = max(0, min(limit, math.floor((ttl - max(0, (tat - now))) / interval)))
+    return RateLimitStatus(allowed, limit, remaining, max(0, (tat - now)), max(0, (tat + interval - ttl - now)))
+
+
+class RateLimiter:
+    """
+    Sharded map of GCRA states, each shard with its own lock and timer wheel.
+
+    A state is [tat, interval, ttl, tick]: the theoretical arrival time
+    (when the limit is full again), the time every hit uses up, the
+    period of the limit and the wheel tick it is due for expiry at.
+    """
+
+    def __init__(self, shards:int = 16, wheel_size:int = 512):
+        self._shards = [({}, [[] for i in range(wheel_size)], [math.floor(time.time())], Lock()) for i in range(shards)]
+        self._wheel_size = wheel_size
+
+
+    def _advance(self, states:dict, wheel:list, last_tick:list, now:float):
+        # Drop states that expired in the slots the wheel passed since the last call
+        now_tick = math.floor(now)
+        for tick in range(max((last_tick[0] + 1), (now_tick - self._wheel_size + 1)), (now_tick + 1)):
+            slot = wheel[tick % self._wheel_size]
+            if len(slot) == 0:
+                continue
+            keep = []
+            for due_tick, key in slot:
+                if due_tick > now_tick:
+                    keep.append((due_tick, key))
+                else:
+                    state = states.get(key)
+                    if (state is not None) and (state[3] == due_tick):
+                        del states[key]
+            wheel[tick % self._wheel_size] = keep
+        last_tick[0] = max(last_tick[0], now_tick)
+
+
+    def check(self, key):
+        """
+        Get the status of a ratelimit without using it up.
+        """
+
+        now = time.time()
+        states, wheel, last_tick, lock = self._shards[hash(key) % len(self._shards)]
+        with lock:
+            self._advance(states, wheel, last_tick, now)
+            state = states.get(key)
+            if (state is None) or (state[0] <= now):
+                return RateLimitStatus(True, None, None, 0, 0)
+            return _status(*state[:3], now, ((state[0] + state[1] - state[2]) <= now))
+
+
+    def hit(self, key, limit:int, ttl:int):
+        """
+        Use up one hit of a ratelimit if it isn't limited.
+        """
+
+        now = time.time()
+        interval = (ttl / limit)
+        states, wheel, last_tick, lock = self._shards[hash(key) % len(self._shards)]
+        with lock:
+            self._advance(states, wheel, last_tick, now)
+            state = states.get(key)
+            if state is None:
+                state = [now, interval, ttl, None]
+                states[key] = state
+            else:
+                state[1], state[2] = interval, ttl
+
+            # Limited if the hit would take the arrival time past the period
+            new_tat = (max(state[0], now) + interval)
+            if (new_tat - ttl) > now:
+                return _status(*state[:3], now, False)
+            state[0] = new_tat
+
+            # Schedule expiry once the limit is full again
+            tick = math.ceil(new_tat)
+            if state[3] != tick:
+                state[3] = tick
+                wheel[tick % self._wheel_size].append((tick, key))
+
+            return _status(*state[:3], now, True)
+
+
+class SharedRateLimiter:
+    """
+    GCRA states in a memory-mapped file shared by every worker on the host.
+
+    The file is a header followed by fixed size slots of (key digest,
+    tat, interval, ttl). A key can only be in the few slots after its
+    home slot, all within one stripe of slots, and a stripe is locked
+    with an fcntl byte range lock while it's being read or updated
+    (plus a thread lock, since fcntl locks don't exclude threads of the
+    same process). Slots whose limit is full again count as free, so
+    nothing needs cleaning up.
+    """
+
+    MAGIC = b"MEOWRL01"
+    HEADER = struct.Struct("8sQ")
+    SLOT = struct.Struct("16sddd")
+    EMPTY = bytes(16)
+
+
+    def __init__(self, path:str, slots:int = 65536, stripe_slots:int = 64, probes:int = 8):
+        if fcntl is None:
+            raise RuntimeError("Shared ratelimits require fcntl")
+
+        self.stripe_slots = stripe_slots
+        self.stripes = max(1, (slots // stripe_slots))
+        self.probes = min(probes, stripe_slots)
+        self._stripe_size = (stripe_slots * self.SLOT.size)
+        size = (self.HEADER.size + (self.stripes * self._stripe_size))
+
+        # Map the file, whoever opens it first (or with a different layout) resets it
+        self._fd = os.open(path, (os.O_RDWR | os.O_CREAT), 0o600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self.HEADER.size, 0)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+            if self.HEADER.unpack_from(self._map, 0) != (self.MAGIC, (self.stripes * stripe_slots)):
+                self._map[:] = bytes(size)
+                self.HEADER.pack_into(self._map, 0, self.MAGIC, (self.stripes * stripe_slots))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.HEADER.size, 0)
+
+        self._locks = [Lock() for i in range(self.stripes)]
+
+
+    def _find(self, digest:bytes, now:float):
+        """
+        Get the offset of the slot a key is in, or should go in, and its state if it has one.
+        """
+
+        home = int.from_bytes(digest[:8], "little")
+        stripe = (home % self.stripes)
+        base = (self.HEADER.size + (stripe * self._stripe_size))
+        first = ((home >> 32) % self.stripe_slots)
+
+        free = None
+        oldest = None
+        for i in range(self.probes):
+            offset = (base + (((first + i) % self.stripe_slots) * self.SLOT.size))
+            slot_digest, tat, interval, ttl = self.SLOT.unpack_from(self._map, offset)
+            if slot_digest == digest:
+                return offset, ((tat, interval, ttl) if tat > now else None)
+            elif (slot_digest == self.EMPTY) or (tat <= now):
+                if free is None:
+                    free = offset
+                if slot_digest == self.EMPTY:
+                    break
+            elif (oldest is None) or (tat < oldest[1]):
+                oldest = (offset, tat)
+
+        # Take over the slot closest to expiring if every slot is in use
+        return (free if free is not None else oldest[0]), None
+
+
+    def _locked(self, digest:bytes, func):
+        stripe = (int.from_bytes(digest[:8], "little") % self.stripes)
+        start = (self.HEADER.size + (stripe * self._stripe_size))
+        with self._locks[stripe]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self._stripe_size, start)
+            try:
+                return func()
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self._stripe_size, start)
+
+
+    def _digest(self, key:tuple):
+        return blake2b("\0".join([str(part) for part in key]).encode(), digest_size = 16).digest()
+
+
+    def check(self, key:tuple):
+        now = time.time()
+        digest = self._digest(key)
+
+        def run():
+            offset, state = self._find(digest, now)
+            if state is None:
+                return RateLimitStatus(True, None, None, 0, 0)
+            return _status(*state, now, ((state[0] + state[1] - state[2]) <= now))
+
+        return self._locked(digest, run)
+
+
+    def hit(self, key:tuple, limit:int, ttl:int):
+        now = time.time()
+        interval = (ttl / limit)
+        digest = self._digest(key)
+
+        def run():
+            offset, state = self._find(digest, now)
+            tat = (state[0] if state is not None else now)
+
+            # Limited if the hit would take the arrival time past the period
+            new_tat = (max(tat, now) + interval)
+            if (new_tat - ttl) > now:
+                return _status(tat, interval, ttl, now, False)
+
+            self.SLOT.pack_into(self._map, offset, digest, new_tat, interval, ttl)
+            return _status(new_tat, interval, ttl, now, True)
+
+        return self._locked(digest, run)
+
+
+def _shared_path():
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm/meowerauth-ratelimits"
     else:
-        return False
+        return os.path.join(tempfile.gettempdir(), "meowerauth-ratelimits")
+
+
+limiter = RateLimiter()
+shared_limiter = None
+
+
+def compile_policies(overrides:dict = {}):
+    """
+    Merge policy overrides into the defaults and resolve which limiter every bucket uses.
+    """
+
+    global shared_limiter
+
+    shared_buckets = set(bucket.strip() for bucket in os.getenv("RATELIMIT_SHARED_BUCKETS", "").split(",") if bucket.strip() != "")
+
+    compiled = {}
+    for bucket in (list(DEFAULT_POLICIES) + [bucket for bucket in overrides if bucket not in DEFAULT_POLICIES]):
+        policy = {**DEFAULT_POLICIES.get(bucket, {}), **overrides.get(bucket, {})}
+        limit, ttl = int(policy["limit"]), float(policy["ttl"])
+        if (limit < 1) or (ttl <= 0):
+            raise ValueError(f"Invalid ratelimit policy for {bucket}: {policy}")
+
+        if policy.get("shared", (("*" in shared_buckets) or (bucket in shared_buckets))):
+            if shared_limiter is None:
+                shared_limiter = SharedRateLimiter(os.getenv("RATELIMIT_SHARED_PATH", _shared_path()), int(os.getenv("RATELIMIT_SHARED_SLOTS", 65536)))
+            compiled[bucket] = Policy(limit, ttl, shared_limiter)
+        else:
+            compiled[bucket] = Policy(limit, ttl, limiter)
+
+    return compiled
+
+
+def _load_policy_file():
+    path = os.getenv("RATELIMIT_POLICY_FILE")
+    if path is None:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+policies = compile_policies(_load_policy_file())
+metrics.describe("ratelimit_hits_total", "counter", "Ratelimit hits by bucket and result", ("bucket", "result"))
+
+
+def watch_policies():
+    """
+    Start a thread that reloads the policy file whenever it changes.
+    """
+
+    path = os.getenv("RATELIMIT_POLICY_FILE")
+    if path is None:
+        return
+
+    def run():
+        global policies
+
+        last_modified = os.stat(path).st_mtime
+        while True:
+            time.sleep(float(os.getenv("RATELIMIT_POLICY_INTERVAL", 5)))
+            try:
+                modified = os.stat(path).st_mtime
+                if modified == last_modified:
+                    continue
+                last_modified = modified
+
+                # Swap the whole table at once, a broken file keeps the current one
+                policies = compile_policies(_load_policy_file())
+                log.info(f"Reloaded ratelimit policies from {path}")
+            except Exception as err:
+                log.error(f"Failed to reload ratelimit policies: {str(err)}")
+
+    Thread(target = run, daemon = True).start()
 
 
 def check_ratelimit(bucket:str, identifier:str):
     """
     Check a ratelimit.
 
-    Returns boolean which indicates if the identifier is ratelimited.
+    Returns the status of the ratelimit if the identifier is ratelimited, otherwise None.
     """
 
-    # Initialize variables
-    ratelimit_id = (str(bucket) + str(identifier))
-    ratelimit_obj = db.mem.execute("SELECT * FROM ratelimits WHERE id = ?", (ratelimit_id,)).fetchone()
+    status = policies[bucket].limiter.check((bucket, identifier))
+    return (status if not status.allowed else None)
 
-    # Return status
-    if (ratelimit_obj is None) or (ratelimit[2] <= time.time()):
-        return False
-    elif ratelimit_obj[1] <= 0:
-        return True
-    else:
-        return False
 
+def ratelimit(bucket:str, identifier:str):
+    """
+    Use up one hit of a ratelimit.
 
-def ratelimit(bucket:str, identifier:str, limit:int, ttl:int):
+    Returns boolean which indicates if the hit was allowed.
     """
-    Create/update a ratelimit.
 
-    Returns boolean which indicates if ratelimit creation/update succeeded.
+    policy = policies[bucket]
+    allowed = policy.limiter.hit((bucket, identifier), policy.limit, policy.ttl).allowed
+    metrics.inc("ratelimit_hits_total", (bucket, ("allowed" if allowed else "limited")))
+    return allowed
+
+
+def ratelimit_headers(status:RateLimitStatus):
+    """
+    Get the RateLimit-* and Retry-After headers for the status of a ratelimit.
     """
 
-    # Initialize variables
-    ratelimit_id = (str(bucket) + str(identifier))
-    ratelimit_obj = db.mem.execute("SELECT * FROM ratelimits WHERE id = ?", (ratelimit_id,)).fetchone()
+    return {
+        "RateLimit-Limit": str(status.limit),
+        "RateLimit-Remaining": str(status.remaining),
+        "RateLimit-Reset": str(math.ceil(status.reset)),
+        "Retry-After": str(math.ceil(status.retry_after))
+    }
 
-    # Check ratelimit status
-    if (ratelimit_obj is None) or (ratelimit[2] <= (time.time() + ttl)):  # Check if ratelimit doesn't exist or has expired
-        ratelimit_obj = (ratelimit_id, (limit - 1), (time.time() + ttl))
-        db.mem.execute("INSERT INTO ratelimits VALUES (?, ?, ?)", ratelimit_obj)
 
-        return True
-    elif ratelimit_obj[1] > 0:  # Check if limit has been reached
-        ratelimit_obj[1] -= 1
-        db.mem.execute("UPDATE ratelimits SET remaining = ? WHERE id = ?", (ratelimit_obj[1], ratelimit_id,))
+def ratelimited(status:RateLimitStatus, detail:str = "You are being ratelimited"):
+    """
+    Get the exception to raise for a ratelimit status from check_ratelimit.
+    """
 
-        return True
-    else:
-        return False
+    return HTTPException(
+        status_code = 429,
+        detail = detail,
+        headers = ratelimit_headers(status)
+    )
 
 
-def auto_ratelimit(bucket:str, identifier:str, limit:int, ttl:int):
+def auto_ratelimit(bucket:str, identifier:str):
     """
     Automatically check and update ratelimit, raise HTTPException if identifier is ratelimited.
     """
 
-    if check_ratelimit(bucket, identifier):
-        raise HTTPException(status_code = 429, detail = "You are being ratelimited")
-    else:
-        ratelimit(bucket, identifier, limit, ttl)
+    policy = policies[bucket]
+    status = policy.limiter.hit((bucket, identifier), policy.limit, policy.ttl)
+    metrics.inc("ratelimit_hits_total", (bucket, ("allowed" if status.allowed else "limited")))
+    if not status.allowed:
+        raise HTTPException(status_code = 429, detail = "You are being ratelimited", headers = ratelimit_headers(status))
@@ -0,0 +1,342 @@
+from util.supporter import log, hash_recovery_code
+from util.logpartitions import LogPartitions
+from collections import namedtuple
+from contextlib import nullcontext
+import sqlite3
+import json
+import time
+import os
+
+
+"""
+Versioned migrations of the persistent SQLite database.
+
+The database's user_version is the number of migrations applied to it.
+A migration is either a list of statements (or functions taking the
+connection), applied together in one transaction, an Index or a
+Backfill. A Backfill moves rows in chunks, each in its own short
+transaction, before its steps run in the versioned transaction, so a
+big table never holds the write lock for long. Moving must be safe to
+repeat.
+
+Applying an Index migration only records it, so startup doesn't wait on
+index builds. build_indexes() builds every recorded index that doesn't
+exist yet, and the storage backend runs it in the background after
+startup. SQLite builds an index in one CREATE INDEX, which holds the
+write lock for the whole build: about 1.5 seconds per million rows of a
+table with a warm OS cache, more when the table has to be read from
+disk. Queries that need the index scan until it's built. A build can
+take longer than the writer's 30 second busy timeout, so every worker
+pauses its writer while it builds or waits for another worker's build,
+and its writes queue up instead of failing with "database is locked".
+Workers that don't build indexes (e.g. ones still running an older
+release during a rolling restart) aren't paused, and their writes fail
+if a build keeps them waiting for more than 30 seconds.
+
+Migrations are only ever appended, never edited once released.
+
+Config:
+* SQLITE_INDEX_CACHE - page cache size while building an index (in KiB)
+* SQLITE_BACKFILL_CHUNK - rows moved per transaction by a Backfill
+* SQLITE_MIGRATION_TIMEOUT - seconds to wait for another worker's migration
+
+Several workers may start at once, so every migration re-checks the
+version once it holds the write lock and is skipped if another worker
+applied it in the meantime.
+"""
+
+
+# Index recorded by a migration and built by build_indexes()
+Index = namedtuple("Index", ["name", "table", "columns"])
+
+# Migration that first moves rows in its own short transactions, then applies its steps
+Backfill = namedtuple("Backfill", ["move", "steps"])
+
+
+def move_mfa(con:sqlite3.Connection):
+    """
+    Move TOTP authenticators and recovery codes still stored as JSON on
+    the accounts table into their own tables, a chunk of accounts at a
+    time in short transactions so writes aren't held up.
+
+    Accounts whose MFA data can't be parsed are left as they are and logged.
+    """
+
+    moved = 0
+    malformed = []
+    last_rowid = 0
+    chunk_size = int(os.getenv("SQLITE_BACKFILL_CHUNK", 5000))
+    while True:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            rows = con.execute("SELECT rowid, id, totp_secret, mfa_recovery FROM accounts WHERE rowid > ? ORDER BY rowid LIMIT ?", (last_rowid, chunk_size)).fetchall()
+            for rowid, userid, totp, recovery in rows:
+                if (totp == "[]") and (recovery == "[]"):
+                    continue
+                try:
+                    authenticators = [(authenticator["id"], userid, authenticator["name"], authenticator["secret"]) for authenticator in json.loads(totp)]
+                    recovery_codes = [(userid, hash_recovery_code(userid, code)) for code in json.loads(recovery)]
+                except (ValueError, TypeError, KeyError):
+                    malformed.append(userid)
+                    continue
+                con.executemany("INSERT OR IGNORE INTO totp_authenticators VALUES (?, ?, ?, ?)", authenticators)
+                con.executemany("INSERT OR IGNORE INTO recovery_codes VALUES (?, ?)", recovery_codes)
+                con.execute("UPDATE accounts SET totp_secret = '[]', mfa_recovery = '[]' WHERE id = ?", (userid,))
+                moved += 1
+            con.execute("COMMIT")
+        except:
+            con.execute("ROLLBACK")
+            raise
+
+        if len(rows) == 0:
+            break
+        last_rowid = rows[-1][0]
+
+    if moved > 0:
+        log.success(f"Moved MFA data of {moved} accounts to the 'totp_authenticators' and 'recovery_codes' tables")
+    if len(malformed) > 0:
+        log.warning(f"Left MFA data that couldn't be parsed on the accounts table, fix it by hand for: {', '.join(malformed)}")
+
+
+def _copy_logs(rows:list):
+    partitions = LogPartitions()
+    try:
+        partitions.write([row[1:] for row in rows])
+    finally:
+        partitions.close()
+
+
+def move_logs(con:sqlite3.Connection):
+    """
+    Move logs out of the main database into the per-day log partitions,
+    a chunk at a time in short transactions so writes aren't held up.
+    """
+
+    moved = 0
+    chunk_size = int(os.getenv("SQLITE_BACKFILL_CHUNK", 5000))
+    while con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'logs'").fetchone() is not None:
+        rows = con.execute("SELECT rowid, id, timestamp, action, details, user, email, ip FROM logs ORDER BY rowid LIMIT ?", (chunk_size,)).fetchall()
+        if len(rows) == 0:
+            break
+
+        # Partitions ignore logs they already have, so a chunk copied twice is harmless
+        _copy_logs(rows)
+        con.execute("BEGIN IMMEDIATE")
+        con.execute("DELETE FROM logs WHERE rowid <= ?", (rows[-1][0],))
+        con.execute("COMMIT")
+        moved += len(rows)
+
+    if moved > 0:
+        log.success(f"Moved {moved} logs to the log partitions")
+
+
+def drop_logs(con:sqlite3.Connection):
+    """
+    Move the logs written since move_logs and drop the table.
+    """
+
+    rows = con.execute("SELECT rowid, id, timestamp, action, details, user, email, ip FROM logs ORDER BY rowid").fetchall()
+    if len(rows) > 0:
+        _copy_logs(rows)
+    con.execute("DROP TABLE logs")
+
+
+MIGRATIONS = [
+    # 1: Tables, databases made before versioning may already have some of them
+    [
+        """
+            CREATE TABLE IF NOT EXISTS accounts (
+                id TEXT NOT NULL UNIQUE PRIMARY KEY,
+                username TEXT NOT NULL UNIQUE,
+                email TEXT UNIQUE,
+                password TEXT,
+                webauthn TEXT NOT NULL,
+                totp_secret TEXT NOT NULL,
+                mfa_recovery TEXT NOT NULL,
+                lock_status INTEGER NOT NULL
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT NOT NULL UNIQUE PRIMARY KEY,
+                auth_hash TEXT NOT NULL UNIQUE,
+                main_hash TEXT NOT NULL UNIQUE,
+                user TEXT NOT NULL,
+                client TEXT NOT NULL,
+                refreshed REAL NOT NULL,
+                expires REAL NOT NULL
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS email_links (
+                id TEXT NOT NULL UNIQUE PRIMARY KEY,
+                user TEXT NOT NULL,
+                email TEXT NOT NULL,
+                action TEXT NOT NULL,
+                expires INTEGER NOT NULL
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS totp_authenticators (
+                id TEXT NOT NULL PRIMARY KEY,
+                user TEXT NOT NULL,
+                name TEXT NOT NULL,
+                secret TEXT NOT NULL
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS recovery_codes (
+                user TEXT NOT NULL,
+                code_hash TEXT NOT NULL,
+                PRIMARY KEY (user, code_hash)
+            ) WITHOUT ROWID
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS logs (
+                id TEXT NOT NULL UNIQUE PRIMARY KEY,
+                timestamp INTEGER NOT NULL,
+                action TEXT NOT NULL,
+                details TEXT NOT NULL,
+                user TEXT,
+                email TEXT,
+                ip TEXT
+            )
+        """,
+
+        # These duplicated the indexes SQLite makes for primary keys and UNIQUE columns
+        "DROP INDEX IF EXISTS account_id",
+        "DROP INDEX IF EXISTS account_username",
+        "DROP INDEX IF EXISTS account_email",
+        "DROP INDEX IF EXISTS session_id",
+        "DROP INDEX IF EXISTS email_link_id"
+    ],
+
+    # 2: Move MFA data out of the accounts table
+    Backfill(move_mfa, []),
+
+    # 3-6: Indexes for authenticator lookups, the expired row sweeper and session listing
+    Index("totp_authenticator_user", "totp_authenticators", ["user"]),
+    Index("session_expires", "sessions", ["expires"]),
+    Index("email_link_expires", "email_links", ["expires"]),
+    Index("session_user_refreshed", "sessions", ["user", "refreshed", "id"]),
+
+    # 7: Replaced by session_user_refreshed
+    ["DROP INDEX IF EXISTS session_user"],
+
+    # 8-9: Accounts waiting to be purged
+    [
+        """
+            CREATE TABLE IF NOT EXISTS pending_deletion (
+                id TEXT NOT NULL PRIMARY KEY,
+                after REAL NOT NULL
+            )
+        """
+    ],
+    Index("pending_deletion_after", "pending_deletion", ["after"]),
+
+    # 10: Logs are kept in per-day files (see util/logpartitions.py)
+    Backfill(move_logs, [drop_logs]),
+
+    # 11: MFA data left behind by accounts purged before it was deleted with them
+    [
+        "DELETE FROM totp_authenticators WHERE user NOT IN (SELECT id FROM accounts)",
+        "DELETE FROM recovery_codes WHERE user NOT IN (SELECT id FROM accounts)"
+    ]
+]
+
+
+def _build_index(con:sqlite3.Connection, index:Index):
+    cache_size = con.execute("PRAGMA cache_size").fetchone()[0]
+    con.execute(f"PRAGMA cache_size = -{int(os.getenv('SQLITE_INDEX_CACHE', 262144))}")
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        if (con.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (index.name,)).fetchone() is not None) or \
+            (con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (index.table,)).fetchone() is None):
+            con.execute("ROLLBACK")
+            return False
+        con.execute(f"CREATE INDEX {index.name} ON {index.table} ({', '.join(index.columns)})")
+        con.execute("COMMIT")
+        return True
+    except:
+        con.execute("ROLLBACK")
+        raise
+    finally:
+        con.execute(f"PRAGMA cache_size = {cache_size}")
+
+
+def _apply(con:sqlite3.Connection, version:int, steps:list):
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        if _version(con) >= version:
+            con.execute("ROLLBACK")
+            return False
+        for step in steps:
+            if callable(step):
+                step(con)
+            else:
+                con.execute(step)
+        con.execute(f"PRAGMA user_version = {version}")
+        con.execute("COMMIT")
+        return True
+    except:
+        con.execute("ROLLBACK")
+        raise
+
+
+def _version(con:sqlite3.Connection):
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _wait_for_others(con:sqlite3.Connection):
+    # Transactions are managed here, wait for other workers migrating at the same time
+    con.isolation_level = None
+    con.execute(f"PRAGMA busy_timeout = {int(float(os.getenv('SQLITE_MIGRATION_TIMEOUT', 600)) * 1000)}")
+
+
+def migrate(con:sqlite3.Connection):
+    """
+    Apply every migration the database doesn't have yet.
+
+    Returns the version the database is at.
+    """
+
+    _wait_for_others(con)
+
+    version = _version(con)
+    if version > len(MIGRATIONS):
+        raise RuntimeError(f"Database is at version {version}, newer than this server knows ({len(MIGRATIONS)})")
+
+    for number, migration in enumerate(MIGRATIONS[version:], start = (version + 1)):
+        started = time.time()
+        if isinstance(migration, Index):
+            applied = _apply(con, number, [])
+        elif isinstance(migration, Backfill):
+            if _version(con) < number:
+                migration.move(con)
+            applied = _apply(con, number, migration.steps)
+        else:
+            applied = _apply(con, number, migration)
+        if applied:
+            log.success(f"Applied database migration {number} in {(time.time() - started):.2f}s")
+
+    return len(MIGRATIONS)
+
+
+def build_indexes(con:sqlite3.Connection, pause = None):
+    """
+    Build the indexes of applied migrations that don't exist yet.
+
+    Every build holds the write lock until it's done, and `pause` (a lock,
+    e.g. one that holds back a writer) while it's waiting and building.
+    """
+
+    _wait_for_others(con)
+
+    for index in MIGRATIONS[:_version(con)]:
+        if not isinstance(index, Index):
+            continue
+        started = time.time()
+        with (pause or nullcontext()):
+            built = _build_index(con, index)
+        if built:
+            log.success(f"Built index {index.name} on {index.table}, holding the write lock for {(time.time() - started):.2f}s")
@@ -62,6 +62,6 @@ class MFARecovery(BaseModel):
         min_length = 1
     )
     code:str = Field(
-        min_length = 8,
-        max_length = 8
+        min_length = 9,
+        max_length = 9
     )
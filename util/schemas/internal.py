@@ -29,3 +29,27 @@ class DeleteAccount(BaseModel):
     immediate:bool = Field(
         default = False
     )
+
+
+class IntrospectTokens(BaseModel):
+    tokens:list[str] = Field(
+        default = [],
+        max_length = 500
+    )
+    hashes:list[str] = Field(
+        default = [],
+        max_length = 500
+    )
+
+
+class Profile(BaseModel):
+    seconds:float = Field(
+        default = 30,
+        gt = 0,
+        le = 300
+    )
+    interval:float = Field(
+        default = 0.01,
+        ge = 0.001,
+        le = 1
+    )
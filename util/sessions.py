@@ -1,7 +1,12 @@
-from util.database import db
-from util.accounts import acc_from_id
+from util.storage import storage
+from util.accounts import Account, acc_from_id, SESSION_TTL
+from util.supporter import log
+from util.tokens import create_main_token
 from util.schemas.settings import ExtraAuth
+from util import metrics
 from fastapi import HTTPException, Request, Header
+from collections import OrderedDict
+from threading import Lock
 from hashlib import sha256
 import time
 import json
@@ -9,17 +14,130 @@ import secrets
 import os
 
 
-class Session:
-    def __init__(self, auth_token:str):
-        if auth_token is not None:
-            # Hash token
-            hashed_token = sha256(auth_token.encode()).hexdigest()
+class SessionCache:
+    """
+    In-process LRU cache of sessions and their account rows keyed by auth hash.
+
+    Entries expire after SESSION_CACHE_TTL seconds and are dropped as soon
+    as the storage backend reports their session ID or main hash revoked
+    or refreshed, or their account changed, by this process or any other.
+
+    Every invalidation bumps the generation. A session read from the
+    database isn't cached if the generation changed during the read, as it
+    may have been revoked after it was read.
+    """
+
+    def __init__(self, max_size:int, ttl:int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._aliases = {}
+        self._users = {}
+        self._lock = Lock()
+
+
+    def get(self, auth_hash:str):
+        with self._lock:
+            entry = self._entries.get(auth_hash)
+            if (entry is None) or (entry[0] <= time.time()):
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(auth_hash)
+            self.hits += 1
+            return entry[1:]
+
+
+    def set(self, auth_hash:str, data:tuple, userdata:tuple, generation:int):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            # Something was invalidated since the rows were read
+            if generation != self.generation:
+                return
+
+            self._remove(auth_hash)
+            self._entries[auth_hash] = ((time.time() + self.ttl), data, userdata)
+            self._aliases[data[0]] = auth_hash
+            self._aliases[data[2]] = auth_hash
+            self._users.setdefault(data[3], set()).add(auth_hash)
+
+            # Evict least recently used entries
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+
+    def invalidate(self, key:str):
+        """
+        Drop a session by its auth hash, session ID or main hash, or all
+        sessions of a user by their user ID.
+        """
 
-            # Get session data
-            data = db.cur.execute("SELECT * FROM sessions WHERE auth_hash = ?", (hashed_token,)).fetchone()
+        with self._lock:
+            self.generation += 1
+            for auth_hash in list(self._users.get(key, ())):
+                self._remove(auth_hash)
+            self._remove(self._aliases.get(key, key))
+
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._aliases.clear()
+            self._users.clear()
+
+
+    def _remove(self, auth_hash:str):
+        entry = self._entries.pop(auth_hash, None)
+        if entry is None:
+            return
+
+        data = entry[1]
+        for key in [data[0], data[2]]:
+            if self._aliases.get(key) == auth_hash:
+                del self._aliases[key]
+        user_hashes = self._users.get(data[3])
+        if user_hashes is not None:
+            user_hashes.discard(auth_hash)
+            if len(user_hashes) == 0:
+                del self._users[data[3]]
+
+
+    def _on_revoked(self, keys:list):
+        # No keys means revocations may have been missed
+        if keys is None:
+            self.clear()
         else:
-            data = None
+            for key in keys:
+                self.invalidate(key)
+
+
+    def listen(self):
+        """
+        Start invalidating sessions as they get revoked and their accounts change.
+        """
 
+        storage.sessions.listen_revocations(self._on_revoked)
+
+
+session_cache = SessionCache(
+    int(os.getenv("SESSION_CACHE_SIZE", 10000)),
+    int(os.getenv("SESSION_CACHE_TTL", 60))
+)
+metrics.register("session_cache_lookups_total", "counter", "Session cache lookups by result", lambda: {
+    ("hit",): session_cache.hits,
+    ("miss",): session_cache.misses
+}, ("result",))
+metrics.register("session_cache_entries", "gauge", "Sessions in the session cache", lambda: len(session_cache._entries))
+
+
+class Session:
+    def __init__(self, data:tuple = None, user = None):
         # Unpack the session data
         if data is None:
             # Set default values
@@ -34,77 +152,103 @@ class Session:
         else:
             # Unpack data
             self.id, self.auth_hash, self.main_hash, self.user, self.client, self.refreshed, self.expires = data
-            self._valid = (self.expires > time.time())
-
-            # Get user object
-            self.user = acc_from_id(self.user)
+            self.client = json.loads(self.client)
+            self.user = user
+            self._valid = ((self.expires > time.time()) and (user is not None) and user._exists)
 
     
-    def refresh(self):
+    async def refresh(self):
         if not self._valid:
             return
 
-        # Delete old token from Mongo
-        db.mongo.sessions.delete_one({"_id": self.main_hash})
+        old_auth_hash = self.auth_hash
+        old_main_hash = self.main_hash
 
-        # Delete old token from Redis
-        db.redis.delete(f"auth:{self.main_hash}")
-
-        # Create new auth and main token secrets
+        # Create new auth and main tokens
         auth_token = ("meow-auth_" + secrets.token_urlsafe(128))
-        main_token = ("meow-main_" + secrets.token_urlsafe(64))
+        main_token, self.main_hash = create_main_token(self.user.id, self.id)
 
-        # Create new auth and main token hashes
+        # Create new auth token hash
         self.auth_hash = sha256(auth_token.encode()).hexdigest()
-        self.main_hash = sha256(main_token.encode()).hexdigest()[:16]
-
-        # Insert main token into Redis
-        db.redis.set(f"auth:{self.main_hash}", self.user, ex = 3600)
-
-        # Insert main token into Mongo database
-        db.mongo.sessions.insert_one({
-            "_id": self.main_hash,
-            "user": self.id,
-            "ttl": (time.time() + 3600)
-        }, {"writeConcern": {"w": "majority", "wtimeout": 5000}})
 
         # Update values on object
         self.refreshed = time.time()
-        self.expires = (time.time() + 7890000)
+        self.expires = (time.time() + SESSION_TTL)
+
+        # Swap the old tokens for the new ones in the database
+        await storage.sessions.refresh(self.id, self.user.id, old_main_hash, self.auth_hash, self.main_hash, self.refreshed, self.expires)
 
-        # Update values in SQLite database
-        db.cur.execute("UPDATE sessions SET auth_hash = ?, main_hash = ?, refreshed = ?, expires = ? WHERE id = ?", (self.auth_hash, self.main_hash, self.refreshed, self.expires, self.id,))
-        db.con.commit()
+        # Drop old session from the cache once it can't be read back from the database
+        session_cache.invalidate(old_auth_hash)
 
         return auth_token, main_token
 
 
-    def revoke(self):
+    async def revoke(self):
         if not self._valid:
             return
 
-        # Delete from SQLite
-        db.cur.execute("DELETE FROM sessions WHERE id = ?", (self.id,))
-        db.con.commit()
+        # Delete from the database and drop from the cache
+        await storage.sessions.revoke(self.id, self.main_hash)
+        session_cache.invalidate(self.auth_hash)
 
-        # Delete from Mongo
-        db.mongo.sessions.delete_one({"_id": self.id})
+        # Clear values
+        self._valid = False
 
-        # Delete from Redis and publish to pubsub
-        db.redis.delete(f"auth:{self.main_hash}")
-        db.redis.publish(os.getenv("REDIS_CHANNEL", "org.meower"), json.dumps({"op": "revoke_session", "val": self.id}))
 
-        # Clear values
-        self = Session(None)
+async def session_from_token(auth_token:str):
+    """
+    Get a session by its auth token.
+    """
+
+    if auth_token is None:
+        return Session(None)
+
+    # Hash token
+    hashed_token = sha256(auth_token.encode()).hexdigest()
+
+    # Get session and account rows from the cache
+    cached = session_cache.get(hashed_token)
+    if cached is not None:
+        data, userdata = cached
+        return Session(data, Account(userdata))
+
+    # Get session and account rows from the database
+    generation = session_cache.generation
+    data = await storage.sessions.get("auth_hash", hashed_token)
+    if data is None:
+        return Session(None)
+    userdata = await storage.accounts.get("id", data[3])
+    if userdata is not None:
+        log.store("got_account", {"method": "id", "user": userdata[0]})
+    session = Session(data, Account(userdata))
+
+    # Cache valid sessions, unless they may have been revoked while being read
+    if session._valid:
+        session_cache.set(session.auth_hash, data, userdata, generation)
+
+    return session
+
+
+async def session_from_id(session_id:str):
+    """
+    Get a session by its ID.
+    """
+
+    data = await storage.sessions.get("id", session_id)
+    if data is None:
+        return Session(None)
+    else:
+        return Session(data, await acc_from_id(data[3]))
 
 
-def check_auth(req:Request, authorization:str = Header()):
+async def check_auth(req:Request, authorization:str = Header()):
     """
     Get authorization of a request.
     """
 
-    req.session = Session(authorization)
-    if not req.session._valid:
+    req.state.session = await session_from_token(authorization)
+    if not req.state.session._valid:
         raise HTTPException(status_code = 401, detail="Unauthorized")
 
 
@@ -113,57 +257,82 @@ async def check_extra_auth(req:Request, body:ExtraAuth):
     Check additional authorization required for certain account settings.
     """
 
-    if not req.session._valid:
+    if not req.state.session._valid:
         raise HTTPException(status_code = 401, detail = "Unauthorized")
 
-    if (body.totp is not None) and (not req.session.user.verify_totp(body.totp)):
+    if (body.totp is not None) and (not await req.state.session.user.verify_totp(body.totp)):
         raise HTTPException(status_code = 401, detail = "Invalid TOTP")
-    elif (body.password is not None) and (not req.session.user.verify_password(body.password)):
+    elif (body.password is not None) and (not await req.state.session.user.verify_password(body.password)):
         raise HTTPException(status_code = 401, detail = "Invalid password")
-    else:
+    elif (body.totp is None) and (body.password is None):
         raise HTTPException(status_code = 400, detail = "No way to authenticate request")
 
 
-def revoke_all_sessions(userid:str):
+async def revoke_all_sessions(userid:str):
     """
     Revoke all of a user's sessions.
     """
 
-    # Get all session IDs and main hashes from the database
-    sessions_ids = []
-    main_hashes = []
-    sessions = db.cur.execute("SELECT id, main_hash FROM sessions WHERE user = ?", (userid,)).fetchall()
-    for item in sessions:
-        sessions_ids.append(item[0])
-        main_hashes.append(item[1])
+    # Delete from the database and drop from the cache
+    for main_hash in await storage.sessions.revoke_all(userid):
+        session_cache.invalidate(main_hash)
+
+
+async def list_sessions(userid:str, limit:int, cursor:str = None):
+    """
+    Get a page of a user's sessions, most recently refreshed first.
+
+    Returns the sessions and a cursor for the next page (None on the last page).
+    """
+
+    # Get one extra row to know whether there is another page
+    if cursor is None:
+        rows = await storage.sessions.list(userid, (limit + 1))
+    else:
+        refreshed, session_id = cursor.split(":", 1)
+        rows = await storage.sessions.list(userid, (limit + 1), (float(refreshed), session_id))
+
+    # Parse sessions
+    sessions = []
+    for session_id, client, refreshed in rows[:limit]:
+        sessions.append({
+            "id": session_id,
+            "client": json.loads(client),
+            "refreshed": refreshed
+        })
+
+    # Create cursor for the next page
+    if len(rows) > limit:
+        next_cursor = f"{sessions[-1]['refreshed']!r}:{sessions[-1]['id']}"
+    else:
+        next_cursor = None
 
-    # Delete from SQLite
-    for session_id in sessions_ids:
-        db.cur.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
-    db.con.commit()
+    return sessions, next_cursor
 
-    # Delete from Mongo
-    db.mongo.sessions.delete_many({"_id": {"$in": main_hashes}})
 
-    # Delete from Redis and publish to pubsub
-    for hash in main_hashes:
-        db.redis.delete(f"auth:{hash}")
-        db.redis.publish(os.getenv("REDIS_CHANNEL", "org.meower"), json.dumps({"op": "revoke_session", "val": hash}))
+async def introspect_main_hashes(main_hashes:list):
+    """
+    Get the user, expiry and lock status of many main token hashes at once.
+
+    Returns a list in the same order as the hashes, with None for
+    any main token that is unknown, revoked or expired.
+    """
+
+    return await storage.sessions.introspect(main_hashes)
 
 
-def get_email_link(token:str):
+async def get_email_link(token:str):
     # Hash token
     hashed_token = sha256(token.encode()).hexdigest()
 
     # Get and return email link details
-    email_link = db.cur.execute("SELECT * FROM email_links WHERE id = ?", (hashed_token,)).fetchone()
-    if (email_link is None) or (email_link[3] > int(time.time())):
+    email_link = await storage.email_links.get(hashed_token)
+    if (email_link is None) or (email_link[4] <= int(time.time())):
         return None
     else:
         return {"hash": email_link[0], "user": email_link[1],  "email": email_link[2],"action": email_link[3], "expires": email_link[4]}
 
 
-def revoke_email_link(hashed_token:str):
+async def revoke_email_link(hashed_token:str):
     # Delete from database
-    db.cur.execute("DELETE FROM email_links WHERE id = ?", (hashed_token,))
-    db.con.commit()
+    await storage.email_links.delete(hashed_token)
@@ -0,0 +1,22 @@
+import os
+
+
+"""
+Storage backend used by the account and session helpers.
+
+Config:
+* STORAGE_BACKEND - sqlite (SQLite, Mongo and Redis) or memory
+"""
+
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+
+
+if STORAGE_BACKEND == "memory":
+    from util.storage.memory import MemoryStorage
+    storage = MemoryStorage()
+elif STORAGE_BACKEND == "sqlite":
+    from util.storage.sqlite import SQLiteStorage
+    storage = SQLiteStorage()
+else:
+    raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
@@ -0,0 +1,233 @@
+from abc import ABC, abstractmethod
+
+
+"""
+Storage interface for the authentication server.
+
+Every backend provides the same stores, so the account and session
+logic never has to know where its data lives.
+
+Rows are passed around as tuples in the same column order as the
+SQLite tables:
+* accounts - ACCOUNT_COLUMNS (id, username, email, password, webauthn, lock_status)
+* sessions - (id, auth_hash, main_hash, user, client, refreshed, expires)
+* email links - (id, user, email, action, expires)
+
+Backends subclass the stores and must implement every abstract method.
+"""
+
+
+class AccountStore(ABC):
+    @abstractmethod
+    async def get(self, field:str, value:str):
+        """
+        Get an account row by its id, username or email.
+        """
+
+
+    @abstractmethod
+    async def create(self, userdata:tuple, profile:dict):
+        """
+        Create an account row and its public profile.
+        """
+
+
+    @abstractmethod
+    async def update(self, userid:str, field:str, value):
+        """
+        Update the email, password or lock status of an account, and
+        report the user ID to listen_revocations callbacks (in every
+        process) so caches drop the old account row.
+        """
+
+
+    @abstractmethod
+    async def add_profile_flag(self, userid:str, flag:int):
+        """
+        Set a flag on the public profile of an account.
+        """
+
+
+    @abstractmethod
+    async def get_totp(self, userid:str):
+        """
+        Get the TOTP authenticators of an account.
+        """
+
+
+    @abstractmethod
+    async def add_totp(self, userid:str, authenticator_id:str, name:str, secret:str):
+        """
+        Add a TOTP authenticator to an account.
+        """
+
+
+    @abstractmethod
+    async def remove_totp(self, userid:str, authenticator_id:str):
+        """
+        Remove a TOTP authenticator, returns whether it existed.
+        """
+
+
+    @abstractmethod
+    async def replace_recovery(self, userid:str, code_hashes:list):
+        """
+        Replace all recovery codes of an account with new ones.
+        """
+
+
+    @abstractmethod
+    async def remove_recovery(self, userid:str, code_hash:str = None):
+        """
+        Remove one recovery code, or all of them if no hash is given.
+
+        Returns whether anything was removed.
+        """
+
+
+    @abstractmethod
+    async def count_recovery(self, userid:str):
+        """
+        Get how many recovery codes an account has left.
+        """
+
+
+class SessionStore(ABC):
+    @abstractmethod
+    async def get(self, field:str, value:str):
+        """
+        Get a session row by its id or auth hash.
+        """
+
+
+    @abstractmethod
+    async def create(self, data:tuple):
+        """
+        Create a session and make its main token usable.
+        """
+
+
+    @abstractmethod
+    async def refresh(self, session_id:str, userid:str, old_main_hash:str, auth_hash:str, main_hash:str, refreshed:float, expires:float):
+        """
+        Swap the tokens of a session for new ones, and report the old main
+        hash to listen_revocations callbacks (in every process) so the old
+        tokens stop being accepted from caches.
+        """
+
+
+    @abstractmethod
+    async def revoke(self, session_id:str, main_hash:str):
+        """
+        Revoke a session and its main token, and report the session ID
+        to listen_revocations callbacks (in every process).
+        """
+
+
+    @abstractmethod
+    async def revoke_all(self, userid:str):
+        """
+        Revoke all of a user's sessions, returns the main hashes of the revoked sessions.
+        """
+
+
+    @abstractmethod
+    async def list(self, userid:str, limit:int, before:tuple = None):
+        """
+        Get (id, client, refreshed) rows of a user's sessions, most
+        recently refreshed first, starting after a (refreshed, id) cursor.
+        """
+
+
+    @abstractmethod
+    async def introspect(self, main_hashes:list):
+        """
+        Get the user, expiry and lock status of many main hashes,
+        None for main tokens that are unknown, revoked or expired.
+        """
+
+
+    @abstractmethod
+    def listen_revocations(self, callback):
+        """
+        Call back with a list of session IDs or main hashes whenever
+        sessions are revoked, with a list of user IDs whenever accounts
+        change, or with None when either may have been missed.
+        """
+
+
+class EmailLinkStore(ABC):
+    @abstractmethod
+    async def get(self, link_hash:str):
+        """
+        Get an email link row by its hash.
+        """
+
+
+    @abstractmethod
+    async def create(self, data:tuple):
+        """
+        Create an email link.
+        """
+
+
+    @abstractmethod
+    async def delete(self, link_hash:str):
+        """
+        Delete an email link.
+        """
+
+
+class MFATokenStore(ABC):
+    @abstractmethod
+    async def get(self, token_hash:str):
+        """
+        Get the user and expiry of an MFA token.
+        """
+
+
+    @abstractmethod
+    async def create(self, token_hash:str, userid:str, expires:float):
+        """
+        Create an MFA token for a user.
+        """
+
+
+class LogStore(ABC):
+    @abstractmethod
+    def store(self, event:str, details:dict):
+        """
+        Store a log without waiting for it to be written.
+        """
+
+
+    def start(self):
+        """
+        Start writing stored logs.
+        """
+
+
+    def close(self):
+        """
+        Write any logs that are still queued.
+        """
+
+
+class Storage(ABC):
+    accounts: AccountStore
+    sessions: SessionStore
+    email_links: EmailLinkStore
+    mfa_tokens: MFATokenStore
+    logs: LogStore
+
+
+    def start(self):
+        """
+        Start any background work the backend needs.
+        """
+
+
+    def close(self):
+        """
+        Flush anything pending and release connections.
+        """
@@ -0,0 +1,271 @@
+from util.tokens import MAIN_TOKEN_TTL
+from util.storage.base import Storage, AccountStore, SessionStore, EmailLinkStore, MFATokenStore, LogStore
+from collections import deque
+import time
+
+
+"""
+In-memory storage backend.
+
+Keeps everything in dicts in the current process and needs no Mongo,
+Redis or SQLite, for local development, tests and benchmarks. Nothing
+survives a restart and revocations only reach this process.
+"""
+
+
+class MemoryAccountStore(AccountStore):
+    def __init__(self):
+        self.accounts = {}
+        self.profiles = {}
+        self.totp = {}
+        self.recovery = {}
+        self._usernames = {}
+        self._emails = {}
+        self._callbacks = []
+
+
+    async def get(self, field:str, value:str):
+        if field == "username":
+            value = self._usernames.get(value)
+        elif field == "email":
+            value = self._emails.get(value)
+
+        userdata = self.accounts.get(value)
+        return (tuple(userdata) if userdata is not None else None)
+
+
+    async def create(self, userdata:tuple, profile:dict):
+        userid, username, email = userdata[:3]
+        if (userid in self.accounts) or (username in self._usernames) or ((email is not None) and (email in self._emails)):
+            raise ValueError("Account already exists")
+
+        self.accounts[userid] = list(userdata)
+        self.profiles[userid] = profile
+        self._usernames[username] = userid
+        if email is not None:
+            self._emails[email] = userid
+
+
+    async def update(self, userid:str, field:str, value):
+        userdata = self.accounts.get(userid)
+        if userdata is None:
+            return
+
+        if field == "email":
+            if (value is not None) and (self._emails.get(value, userid) != userid):
+                raise ValueError("Email already in use")
+            self._emails.pop(userdata[2], None)
+            if value is not None:
+                self._emails[value] = userid
+            userdata[2] = value
+        elif field == "password":
+            userdata[3] = value
+        elif field == "lock_status":
+            userdata[5] = value
+
+        for callback in self._callbacks:
+            callback([userid])
+
+
+    async def add_profile_flag(self, userid:str, flag:int):
+        if userid in self.profiles:
+            self.profiles[userid]["flags"] |= flag
+
+
+    async def get_totp(self, userid:str):
+        return [dict(authenticator) for authenticator in self.totp.get(userid, [])]
+
+
+    async def add_totp(self, userid:str, authenticator_id:str, name:str, secret:str):
+        self.totp.setdefault(userid, []).append({"id": authenticator_id, "name": name, "secret": secret})
+
+
+    async def remove_totp(self, userid:str, authenticator_id:str):
+        authenticators = self.totp.get(userid, [])
+        remaining = [authenticator for authenticator in authenticators if authenticator["id"] != authenticator_id]
+        self.totp[userid] = remaining
+        return (len(remaining) < len(authenticators))
+
+
+    async def replace_recovery(self, userid:str, code_hashes:list):
+        self.recovery[userid] = set(code_hashes)
+
+
+    async def remove_recovery(self, userid:str, code_hash:str = None):
+        if code_hash is None:
+            self.recovery.pop(userid, None)
+            return True
+        elif code_hash in self.recovery.get(userid, ()):
+            self.recovery[userid].remove(code_hash)
+            return True
+        else:
+            return False
+
+
+    async def count_recovery(self, userid:str):
+        return len(self.recovery.get(userid, ()))
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self, accounts:MemoryAccountStore):
+        self.accounts = accounts
+        self.sessions = {}
+        self.main_tokens = {}
+        self._auth_hashes = {}
+        self._main_hashes = {}
+        self._user_sessions = {}
+
+        # Account updates are reported to the same callbacks
+        self._callbacks = accounts._callbacks
+
+
+    async def get(self, field:str, value:str):
+        if field == "auth_hash":
+            value = self._auth_hashes.get(value)
+
+        data = self.sessions.get(value)
+        return (tuple(data) if data is not None else None)
+
+
+    async def create(self, data:tuple):
+        session_id, auth_hash, main_hash, userid = data[:4]
+        self.sessions[session_id] = list(data)
+        self._auth_hashes[auth_hash] = session_id
+        self._main_hashes[main_hash] = session_id
+        self._user_sessions.setdefault(userid, set()).add(session_id)
+        self.main_tokens[main_hash] = (time.time() + MAIN_TOKEN_TTL)
+
+
+    async def refresh(self, session_id:str, userid:str, old_main_hash:str, auth_hash:str, main_hash:str, refreshed:float, expires:float):
+        data = self.sessions.get(session_id)
+        if data is None:
+            return
+
+        self.main_tokens.pop(old_main_hash, None)
+        self._auth_hashes.pop(data[1], None)
+        self._main_hashes.pop(data[2], None)
+
+        data[1], data[2], data[5], data[6] = auth_hash, main_hash, refreshed, expires
+        self._auth_hashes[auth_hash] = session_id
+        self._main_hashes[main_hash] = session_id
+        self.main_tokens[main_hash] = (time.time() + MAIN_TOKEN_TTL)
+        self._publish([old_main_hash])
+
+
+    def _delete(self, session_id:str):
+        data = self.sessions.pop(session_id, None)
+        if data is None:
+            return None
+
+        self._auth_hashes.pop(data[1], None)
+        self._main_hashes.pop(data[2], None)
+        self._user_sessions.get(data[3], set()).discard(session_id)
+        self.main_tokens.pop(data[2], None)
+        return data[2]
+
+
+    def _publish(self, keys:list):
+        for callback in self._callbacks:
+            callback(keys)
+
+
+    async def revoke(self, session_id:str, main_hash:str):
+        self._delete(session_id)
+        self.main_tokens.pop(main_hash, None)
+        self._publish([session_id])
+
+
+    async def revoke_all(self, userid:str):
+        main_hashes = [self._delete(session_id) for session_id in list(self._user_sessions.pop(userid, ()))]
+        main_hashes = [main_hash for main_hash in main_hashes if main_hash is not None]
+        if len(main_hashes) > 0:
+            self._publish(main_hashes)
+        return main_hashes
+
+
+    async def list(self, userid:str, limit:int, before:tuple = None):
+        rows = sorted(
+            [(self.sessions[session_id][5], session_id) for session_id in self._user_sessions.get(userid, ())],
+            reverse = True
+        )
+        if before is not None:
+            rows = [row for row in rows if row < before]
+        return [(session_id, self.sessions[session_id][4], refreshed) for refreshed, session_id in rows[:limit]]
+
+
+    async def introspect(self, main_hashes:list):
+        results = []
+        for main_hash in main_hashes:
+            session_id = self._main_hashes.get(main_hash)
+            if (session_id is None) or (self.main_tokens.get(main_hash, 0) <= time.time()):
+                results.append(None)
+                continue
+
+            data = self.sessions[session_id]
+            userdata = self.accounts.accounts.get(data[3])
+            if userdata is None:
+                results.append(None)
+            else:
+                results.append({
+                    "user": data[3],
+                    "expires": (data[5] + MAIN_TOKEN_TTL),
+                    "lock_status": userdata[5]
+                })
+        return results
+
+
+    def listen_revocations(self, callback):
+        self._callbacks.append(callback)
+
+
+class MemoryEmailLinkStore(EmailLinkStore):
+    def __init__(self):
+        self.links = {}
+
+
+    async def get(self, link_hash:str):
+        return self.links.get(link_hash)
+
+
+    async def create(self, data:tuple):
+        self.links[data[0]] = tuple(data)
+
+
+    async def delete(self, link_hash:str):
+        self.links.pop(link_hash, None)
+
+
+class MemoryMFATokenStore(MFATokenStore):
+    def __init__(self):
+        self.tokens = {}
+
+
+    async def get(self, token_hash:str):
+        token_data = self.tokens.get(token_hash)
+        if (token_data is not None) and (token_data[1] <= time.time()):
+            del self.tokens[token_hash]
+            return None
+        return token_data
+
+
+    async def create(self, token_hash:str, userid:str, expires:float):
+        self.tokens[token_hash] = (userid, expires)
+
+
+class MemoryLogStore(LogStore):
+    def __init__(self):
+        # Only the most recent logs are kept
+        self.logs = deque(maxlen = 10000)
+
+
+    def store(self, event:str, details:dict):
+        self.logs.append((int(time.time()), event, details))
+
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.accounts = MemoryAccountStore()
+        self.sessions = MemorySessionStore(self.accounts)
+        self.email_links = MemoryEmailLinkStore()
+        self.mfa_tokens = MemoryMFATokenStore()
+        self.logs = MemoryLogStore()
@@ -0,0 +1,373 @@
+from util.database import db, MAJORITY
+from util.supporter import log, snowflake
+from util.tokens import MAIN_TOKEN_TTL
+from util.queries import QUERIES
+from util.timing import timed
+from util.logpartitions import LogPartitions
+from util import metrics
+from util.storage.base import Storage, AccountStore, SessionStore, EmailLinkStore, MFATokenStore, LogStore
+from threading import Thread
+import queue
+import asyncio
+import json
+import time
+import os
+
+
+"""
+Default storage backend.
+
+Accounts, sessions and email links are kept in SQLite, logs in per-day
+SQLite files (see util/logpartitions.py), MFA tokens in the in-memory
+SQLite database, public profiles in Mongo and main
+tokens in both Redis and Mongo so the REST API and CloudLink servers
+can look them up. Revocations are published on REDIS_CHANNEL, and so
+are account changes (update_account with the user ID) so every worker
+drops the sessions it cached with the old account row. Other consumers
+of the channel can ignore update_account.
+
+Logs are queued in memory and written in batches by one thread. When
+the queue is full new logs are dropped instead of slowing requests down.
+
+Config:
+* LOG_QUEUE_SIZE - logs that can wait to be written
+* LOG_BATCH_SIZE - most logs written in one transaction
+* LOG_FLUSH_INTERVAL - milliseconds a log may wait for its batch to fill up
+* LOG_MAINTENANCE_INTERVAL - seconds between expiring and compressing log partitions
+"""
+
+
+class SQLiteAccountStore(AccountStore):
+    async def get(self, field:str, value:str):
+        return await db.afetchone(QUERIES[f"account_by_{field}"], (value,))
+
+
+    async def create(self, userdata:tuple, profile:dict):
+        await timed("mongo", db.amongo.users.with_options(write_concern = MAJORITY).insert_one(profile))
+        await db.awrite(QUERIES["create_account"], userdata)
+
+
+    async def update(self, userid:str, field:str, value):
+        await db.awrite(QUERIES[f"update_account_{field}"], (value, userid,))
+
+        # Let every worker drop the account from its session cache
+        await timed("redis", db.aredis.publish(os.getenv("REDIS_CHANNEL", "org.meower"), json.dumps({"op": "update_account", "val": userid})))
+
+
+    async def add_profile_flag(self, userid:str, flag:int):
+        await timed("mongo", db.amongo.users.update_one({"_id": userid}, {"$bit": {"flags": {"or": flag}}}))
+
+
+    async def get_totp(self, userid:str):
+        return [
+            {"id": authenticator_id, "name": name, "secret": secret}
+            for authenticator_id, name, secret in await db.afetchall(QUERIES["totp_by_user"], (userid,))
+        ]
+
+
+    async def add_totp(self, userid:str, authenticator_id:str, name:str, secret:str):
+        await db.awrite(QUERIES["add_totp"], (authenticator_id, userid, name, secret,))
+
+
+    async def remove_totp(self, userid:str, authenticator_id:str):
+        return ((await db.awrite(QUERIES["remove_totp"], (authenticator_id, userid,))).rowcount > 0)
+
+
+    async def replace_recovery(self, userid:str, code_hashes:list):
+        await db.atransaction([
+            (QUERIES["remove_recovery_codes"], (userid,)),
+            (QUERIES["add_recovery_code"], [(userid, code_hash) for code_hash in code_hashes], True)
+        ])
+
+
+    async def remove_recovery(self, userid:str, code_hash:str = None):
+        if code_hash is None:
+            await db.awrite(QUERIES["remove_recovery_codes"], (userid,))
+            return True
+        else:
+            return ((await db.awrite(QUERIES["remove_recovery_code"], (userid, code_hash,))).rowcount > 0)
+
+
+    async def count_recovery(self, userid:str):
+        return (await db.afetchone(QUERIES["count_recovery_codes"], (userid,)))[0]
+
+
+class SQLiteSessionStore(SessionStore):
+    async def get(self, field:str, value:str):
+        return await db.afetchone(QUERIES[f"session_by_{field}"], (value,))
+
+
+    async def _add_main_token(self, main_hash:str, userid:str):
+        # Insert main token into Redis and Mongo database at the same time
+        await asyncio.gather(
+            timed("redis", db.aredis.set(f"auth:{main_hash}", userid, ex = MAIN_TOKEN_TTL)),
+            timed("mongo", db.amongo.sessions.with_options(write_concern = MAJORITY).insert_one({
+                "_id": main_hash,
+                "user": userid,
+                "ttl": (time.time() + MAIN_TOKEN_TTL)
+            }))
+        )
+
+
+    async def create(self, data:tuple):
+        await db.awrite(QUERIES["create_session"], data)
+        await self._add_main_token(data[2], data[3])
+
+
+    async def refresh(self, session_id:str, userid:str, old_main_hash:str, auth_hash:str, main_hash:str, refreshed:float, expires:float):
+        # Delete old token from Mongo and Redis
+        await asyncio.gather(
+            timed("mongo", db.amongo.sessions.delete_one({"_id": old_main_hash})),
+            timed("redis", db.aredis.delete(f"auth:{old_main_hash}"))
+        )
+
+        await self._add_main_token(main_hash, userid)
+        await db.awrite(QUERIES["refresh_session"], (auth_hash, main_hash, refreshed, expires, session_id,))
+
+        # Let other workers drop the old auth token from their caches and signed
+        # token consumers drop the old main token, the session itself lives on
+        await timed("redis", db.aredis.publish(os.getenv("REDIS_CHANNEL", "org.meower"), json.dumps({"op": "revoke_session", "val": old_main_hash})))
+
+
+    async def revoke(self, session_id:str, main_hash:str):
+        # Delete from SQLite and Mongo
+        await db.awrite(QUERIES["delete_session"], (session_id,))
+        await timed("mongo", db.amongo.sessions.delete_one({"_id": main_hash}))
+
+        # Delete from Redis and publish to pubsub
+        pipeline = db.aredis.pipeline(transaction = False)
+        pipeline.delete(f"auth:{main_hash}")
+        pipeline.publish(os.getenv("REDIS_CHANNEL", "org.meower"), json.dumps({"op": "revoke_session", "val": session_id}))
+        await timed("redis", pipeline.execute())
+
+
+    async def revoke_all(self, userid:str):
+        # Delete from SQLite and get the main hashes of the deleted sessions
+        main_hashes = [row[0] for row in (await db.awrite(QUERIES["delete_user_sessions"], (userid,))).rows]
+        if len(main_hashes) == 0:
+            return main_hashes
+
+        # Delete from Mongo
+        await timed("mongo", db.amongo.sessions.delete_many({"_id": {"$in": main_hashes}}))
+
+        # Delete from Redis and publish to pubsub in one round trip,
+        # one revoke_session per main hash as the other pubsub consumers expect
+        pipeline = db.aredis.pipeline(transaction = False)
+        pipeline.delete(*[f"auth:{main_hash}" for main_hash in main_hashes])
+        for main_hash in main_hashes:
+            pipeline.publish(os.getenv("REDIS_CHANNEL", "org.meower"), json.dumps({"op": "revoke_session", "val": main_hash}))
+        await timed("redis", pipeline.execute())
+
+        return main_hashes
+
+
+    async def list(self, userid:str, limit:int, before:tuple = None):
+        if before is None:
+            return await db.afetchall(QUERIES["list_sessions"], (userid, limit,))
+        else:
+            return await db.afetchall(QUERIES["list_sessions_after"], (userid, before[0], before[1], limit,))
+
+
+    async def introspect(self, main_hashes:list):
+        # Get the main tokens that are still active from Redis
+        active_hashes = []
+        known_hashes = [main_hash for main_hash in main_hashes if main_hash is not None]
+        if len(known_hashes) > 0:
+            for main_hash, userid in zip(known_hashes, await timed("redis", db.aredis.mget([f"auth:{main_hash}" for main_hash in known_hashes]))):
+                if userid is not None:
+                    active_hashes.append(main_hash)
+
+        # Get session and account details of the active main tokens, passed as
+        # one JSON array so any amount of them fits in SQLite's variable limit
+        sessions = {}
+        if len(active_hashes) > 0:
+            for main_hash, userid, refreshed, lock_status in await db.afetchall(QUERIES["introspect_sessions"], (json.dumps(active_hashes),)):
+                sessions[main_hash] = {
+                    "user": userid,
+                    "expires": (refreshed + MAIN_TOKEN_TTL),
+                    "lock_status": lock_status
+                }
+
+        # Return details in the requested order
+        return [sessions.get(main_hash) for main_hash in main_hashes]
+
+
+    def listen_revocations(self, callback):
+        def run():
+            while True:
+                try:
+                    pubsub = db.redis.pubsub(ignore_subscribe_messages = True)
+                    pubsub.subscribe(os.getenv("REDIS_CHANNEL", "org.meower"))
+
+                    # Anything revoked while we weren't subscribed is unknown
+                    callback(None)
+
+                    for message in pubsub.listen():
+                        try:
+                            payload = json.loads(message["data"])
+                        except:
+                            continue
+                        if not isinstance(payload, dict):
+                            continue
+                        elif payload.get("op") in ["revoke_session", "update_account"]:
+                            callback([payload["val"]])
+                except Exception as err:
+                    log.error(f"Lost pubsub connection: {str(err)}")
+                    callback(None)
+                    time.sleep(1)
+
+        Thread(target = run, daemon = True).start()
+
+
+class SQLiteEmailLinkStore(EmailLinkStore):
+    async def get(self, link_hash:str):
+        return await db.afetchone(QUERIES["email_link_by_id"], (link_hash,))
+
+
+    async def create(self, data:tuple):
+        await db.awrite(QUERIES["create_email_link"], data)
+
+
+    async def delete(self, link_hash:str):
+        await db.awrite(QUERIES["delete_email_link"], (link_hash,))
+
+
+class SQLiteMFATokenStore(MFATokenStore):
+    async def get(self, token_hash:str):
+        with db.mem_lock:
+            return db.mem.execute("SELECT user, expires FROM mfa WHERE id = ?", (token_hash,)).fetchone()
+
+
+    async def create(self, token_hash:str, userid:str, expires:float):
+        with db.mem_lock:
+            db.mem.execute("INSERT INTO mfa VALUES (?, ?, ?)", (token_hash, userid, expires,))
+
+
+class SQLiteLogStore(LogStore):
+    def __init__(self):
+        self.batch_size = int(os.getenv("LOG_BATCH_SIZE", 500))
+        self.flush_interval = (int(os.getenv("LOG_FLUSH_INTERVAL", 250)) / 1000)
+        self.maintenance_interval = int(os.getenv("LOG_MAINTENANCE_INTERVAL", 3600))
+        self.partitions = None
+        self.counts = {"written": 0, "dropped": 0, "failed": 0}
+        self._queue = queue.Queue(maxsize = int(os.getenv("LOG_QUEUE_SIZE", 10000)))
+        self._writer_thread = None
+
+        metrics.register("log_queue_depth", "gauge", "Logs waiting to be written", self.queue_depth)
+        metrics.register("logs_total", "counter", "Stored logs by result", lambda: {
+            (result,): count for result, count in self.counts.items()
+        }, ("result",))
+
+
+    def store(self, event:str, details:dict):
+        row = (
+            snowflake(),
+            int(time.time()),
+            event,
+            json.dumps(details),
+            details.get("user"),
+            details.get("email"),
+            details.get("ip")
+        )
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.counts["dropped"] += 1
+
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+
+    def start(self):
+        """
+        Open the partitions and start the log writer, logs stored before
+        this wait in the queue.
+        """
+
+        if self._writer_thread is not None:
+            return
+        self.partitions = LogPartitions()
+        self._writer_thread = Thread(target = self._writer, daemon = True)
+        self._writer_thread.start()
+
+
+    def _writer(self):
+        """
+        Writes queued logs in batches, each batch in one transaction per
+        partition. A batch is written once it's full or its first log has
+        waited for the flush interval. Partitions are maintained in between,
+        logs queue up meanwhile.
+        """
+
+        next_maintenance = time.monotonic()
+        while True:
+            # Expire and compress partitions when it's time
+            if time.monotonic() >= next_maintenance:
+                self.partitions.maintain()
+                next_maintenance = (time.monotonic() + self.maintenance_interval)
+
+            try:
+                row = self._queue.get(timeout = max(0, (next_maintenance - time.monotonic())))
+            except queue.Empty:
+                continue
+            if row is None:
+                break
+
+            # Gather logs until the batch is full or the flush interval is up
+            rows = [row]
+            stopping = False
+            deadline = (time.monotonic() + self.flush_interval)
+            while len(rows) < self.batch_size:
+                try:
+                    row = self._queue.get(timeout = max(0, (deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+                if row is None:
+                    stopping = True
+                    break
+                rows.append(row)
+
+            try:
+                self.partitions.write(rows)
+                self.counts["written"] += len(rows)
+            except Exception as err:
+                self.counts["failed"] += len(rows)
+                log.error(f"Failed to write {len(rows)} logs: {str(err)}")
+
+            if stopping:
+                break
+
+        self.partitions.close()
+
+
+    def close(self):
+        """
+        Write any queued logs and stop the log writer.
+        """
+
+        if (self._writer_thread is not None) and self._writer_thread.is_alive():
+            self._queue.put(None)
+            self._writer_thread.join()
+
+
+class SQLiteStorage(Storage):
+    def __init__(self):
+        self.accounts = SQLiteAccountStore()
+        self.sessions = SQLiteSessionStore()
+        self.email_links = SQLiteEmailLinkStore()
+        self.mfa_tokens = SQLiteMFATokenStore()
+        self.logs = SQLiteLogStore()
+
+
+    def start(self):
+        self.logs.start()
+
+        # Build indexes recorded by migrations and clean up expired data in the background
+        Thread(target = db.build_indexes, daemon = True).start()
+        Thread(target = db.background_cleanup, daemon = True).start()
+
+
+    def close(self):
+        self.logs.close()
+        db.close()
@@ -1,9 +1,7 @@
-from util.database import db
 from datetime import datetime
-from threading import Thread
+from hashlib import sha256
 import os
 import time
-import json
 import string
 
 
@@ -52,12 +50,9 @@ class log:
         something goes bad and someone needs to review them.
         """
 
-        def run():
-            db.cur.execute("INSERT INTO logs VALUES (?, ?, ?, ?)", (None, int(time.time()), event, json.dumps(details),))
-            db.con.commit()
-        
-        # Thread the main runner so it doesn't hold up the main process
-        Thread(target = run).start()
+        # Imported here, the storage backends use these helpers too
+        from util.storage import storage
+        storage.logs.store(event, details)
 
 
 def snowflake():
@@ -71,11 +66,21 @@ def snowflake():
     4) An incremental counter
     """
 
+    global id_increment
+
     # Add increment
     id_increment += 1
 
     # Generate and return uid
-    return (str(time()) + str(os.getenv("SERVER_ID", "0")) + str(os.getpid()) + str(id_increment))
+    return (str(int(time.time() * 1000)) + str(os.getenv("SERVER_ID", "0")) + str(os.getpid()) + str(id_increment))
+
+
+def hash_recovery_code(userid:str, code:str):
+    """
+    Hash an MFA recovery code, codes are only ever stored hashed.
+    """
+
+    return sha256(f"{userid}:{code}".encode()).hexdigest()
 
 
 def check_username(username:str):
@@ -0,0 +1,125 @@
+from util.supporter import log
+from util import metrics
+from contextvars import ContextVar
+import random
+import json
+import time
+import os
+
+
+"""
+Per-request timing of backend calls.
+
+Backend calls in util/ are wrapped in spans, which are recorded into
+the current request's span list (kept in a context variable, so tasks
+started by the request record into it too). The middleware turns them
+into a Server-Timing header with the total duration and call count of
+every stage, and writes a sampled structured log line.
+
+Every span is also added to the backend_call_seconds histogram, in or
+outside of a request.
+
+Config:
+* SERVER_TIMING - whether to send the Server-Timing header
+* TIMING_LOG_SAMPLE_RATE - fraction of requests to log the timings of
+* TIMING_LOG_SLOW_MS - always log the timings of requests slower than this
+"""
+
+
+SERVER_TIMING = (os.getenv("SERVER_TIMING", "true").lower() == "true")
+TIMING_LOG_SAMPLE_RATE = float(os.getenv("TIMING_LOG_SAMPLE_RATE", 0.01))
+TIMING_LOG_SLOW_MS = float(os.getenv("TIMING_LOG_SLOW_MS", 1000))
+
+
+# Spans of the current request, a list of (stage, seconds)
+_spans = ContextVar("spans", default = None)
+
+
+metrics.describe("backend_call_seconds", "histogram", "Latency of backend calls by stage", ("stage",))
+
+
+class span:
+    """
+    Time a stage of the current request, use as a context manager.
+    """
+
+    __slots__ = ("name", "started")
+
+    def __init__(self, name:str):
+        self.name = name
+
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc):
+        duration = (time.perf_counter() - self.started)
+        metrics.observe("backend_call_seconds", duration, (self.name,))
+        spans = _spans.get()
+        if spans is not None:
+            spans.append((self.name, duration))
+
+
+async def timed(name:str, awaitable):
+    """
+    Await something inside a span, for timing calls passed to asyncio.gather.
+    """
+
+    with span(name):
+        return await awaitable
+
+
+def start_request():
+    """
+    Start recording spans for the current request.
+    """
+
+    spans = []
+    _spans.set(spans)
+    return spans
+
+
+def summarize(spans:list):
+    """
+    Get the total duration (in milliseconds) and amount of calls of every stage, in order of first call.
+    """
+
+    stages = {}
+    for name, duration in spans:
+        if name in stages:
+            stages[name][0] += (duration * 1000)
+            stages[name][1] += 1
+        else:
+            stages[name] = [(duration * 1000), 1]
+    return stages
+
+
+def server_timing(spans:list, total:float):
+    """
+    Get the Server-Timing header value for the spans of a request.
+    """
+
+    metrics = [f'{name};dur={duration:.2f};desc="{calls}x"' for name, (duration, calls) in summarize(spans).items()]
+    metrics.append(f"total;dur={(total * 1000):.2f}")
+    return ", ".join(metrics)
+
+
+def log_request(method:str, path:str, status:int, spans:list, total:float):
+    """
+    Log the timings of a request if it was sampled or slow.
+    """
+
+    total_ms = (total * 1000)
+    if (total_ms < TIMING_LOG_SLOW_MS) and (random.random() >= TIMING_LOG_SAMPLE_RATE):
+        return
+
+    log.info(json.dumps({
+        "event": "request_timing",
+        "method": method,
+        "path": path,
+        "status": status,
+        "total_ms": round(total_ms, 2),
+        "stages": {name: {"ms": round(duration, 2), "calls": calls} for name, (duration, calls) in summarize(spans).items()}
+    }, separators = (",", ":")))
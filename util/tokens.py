@@ -0,0 +1,166 @@
+from hashlib import sha256
+import base64
+import hmac
+import json
+import secrets
+import time
+import os
+
+try:
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+except ImportError:
+    Ed25519PrivateKey = None
+
+
+"""
+Main tokens for the REST API and CloudLink servers.
+
+By default main tokens are opaque random strings that downstream servers
+look up by hash in Redis or Mongo. With MAIN_TOKEN_MODE set to "signed"
+they are compact JWS tokens carrying the user ID, the session ID, a token
+ID and an expiry, so downstream servers can verify them locally with the
+key set published at /internal/keys. The token ID is used as the main
+hash. revoke_session messages on REDIS_CHANNEL carry either a session ID
+(a revoked session, match it against "sid") or a main hash (a replaced or
+revoked token, match it against "jti"), so revocations reach signed
+tokens too.
+
+Config:
+* MAIN_TOKEN_MODE - opaque or signed
+* MAIN_TOKEN_TTL - lifetime of main tokens (in seconds)
+* MAIN_TOKEN_KEYS - JSON list of signing keys, either
+  {"kid": "...", "alg": "HS256", "secret": "..."} or
+  {"kid": "...", "alg": "EdDSA", "private_key": "<base64 32 byte seed>"}
+* MAIN_TOKEN_KID - key ID used to sign new tokens (defaults to the first key)
+
+Ed25519 keys require the cryptography package.
+"""
+
+
+MAIN_TOKEN_MODE = os.getenv("MAIN_TOKEN_MODE", "opaque")
+MAIN_TOKEN_TTL = int(os.getenv("MAIN_TOKEN_TTL", 3600))
+
+
+def _b64encode(data:bytes):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data:str):
+    return base64.urlsafe_b64decode(data + ("=" * (-len(data) % 4)))
+
+
+def _load_keys():
+    keys = {}
+    for key in json.loads(os.getenv("MAIN_TOKEN_KEYS", "[]")):
+        if key["alg"] == "HS256":
+            keys[key["kid"]] = ("HS256", key["secret"].encode())
+        elif key["alg"] == "EdDSA":
+            if Ed25519PrivateKey is None:
+                raise RuntimeError("EdDSA main token keys require the cryptography package")
+            keys[key["kid"]] = ("EdDSA", Ed25519PrivateKey.from_private_bytes(base64.b64decode(key["private_key"])))
+        else:
+            raise ValueError(f"Unknown main token key algorithm: {key['alg']}")
+    return keys
+
+
+# Signing keys by key ID
+KEYS = _load_keys()
+SIGNING_KID = os.getenv("MAIN_TOKEN_KID", next(iter(KEYS), None))
+if (MAIN_TOKEN_MODE == "signed") and (SIGNING_KID not in KEYS):
+    raise RuntimeError("Signed main tokens require a signing key in MAIN_TOKEN_KEYS")
+
+
+def _sign(alg:str, key, data:bytes):
+    if alg == "HS256":
+        return hmac.new(key, data, sha256).digest()
+    else:
+        return key.sign(data)
+
+
+def _verify_signature(alg:str, key, data:bytes, signature:bytes):
+    if alg == "HS256":
+        return hmac.compare_digest(hmac.new(key, data, sha256).digest(), signature)
+    else:
+        try:
+            key.public_key().verify(signature, data)
+            return True
+        except:
+            return False
+
+
+def create_main_token(userid:str, session_id:str):
+    """
+    Create a new main token for a user's session.
+
+    Returns the main token and the hash it should be stored under.
+    """
+
+    if MAIN_TOKEN_MODE != "signed":
+        main_token = ("meow-main_" + secrets.token_urlsafe(64))
+        return main_token, sha256(main_token.encode()).hexdigest()[:16]
+
+    # Create signed token
+    alg, key = KEYS[SIGNING_KID]
+    main_hash = secrets.token_hex(8)
+    header = _b64encode(json.dumps({"alg": alg, "typ": "JWT", "kid": SIGNING_KID}, separators = (",", ":")).encode())
+    payload = _b64encode(json.dumps({
+        "sub": userid,
+        "sid": session_id,
+        "jti": main_hash,
+        "iat": int(time.time()),
+        "exp": (int(time.time()) + MAIN_TOKEN_TTL)
+    }, separators = (",", ":")).encode())
+    signature = _b64encode(_sign(alg, key, f"{header}.{payload}".encode()))
+
+    return f"meow-main_{header}.{payload}.{signature}", main_hash
+
+
+def verify_main_token(main_token:str):
+    """
+    Verify a signed main token.
+
+    Returns the token claims, or None if the token is invalid or expired.
+    """
+
+    try:
+        header, payload, signature = main_token.removeprefix("meow-main_").split(".")
+        kid = json.loads(_b64decode(header))["kid"]
+        alg, key = KEYS[kid]
+        if not _verify_signature(alg, key, f"{header}.{payload}".encode(), _b64decode(signature)):
+            return None
+        claims = json.loads(_b64decode(payload))
+    except:
+        return None
+
+    if claims["exp"] <= time.time():
+        return None
+    else:
+        return claims
+
+
+def hash_main_token(main_token:str):
+    """
+    Get the hash a main token is stored under.
+    """
+
+    if main_token.count(".") == 2:
+        claims = verify_main_token(main_token)
+        return (claims["jti"] if claims is not None else None)
+    else:
+        return sha256(main_token.encode()).hexdigest()[:16]
+
+
+def key_set():
+    """
+    Get the main token verification keys as a JSON Web Key Set.
+    """
+
+    keys = []
+    for kid, (alg, key) in KEYS.items():
+        if alg == "HS256":
+            keys.append({"kty": "oct", "kid": kid, "alg": alg, "use": "sig", "k": _b64encode(key)})
+        else:
+            public_key = key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+            keys.append({"kty": "OKP", "crv": "Ed25519", "kid": kid, "alg": alg, "use": "sig", "x": _b64encode(public_key)})
+    return {"keys": keys}